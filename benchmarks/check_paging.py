@@ -0,0 +1,59 @@
+"""Check that paged and windowed Hypothesis searches return every row once.
+
+    python benchmarks/check_paging.py
+
+Rows are served by the fake upstream with many equal updated times, at
+page boundaries and exactly on whole-second window edges, which an
+exclusive search_after cursor makes easy to lose.
+"""
+from datetime import datetime, timedelta
+from fake_upstream import FakeUpstream, make_rows
+import random
+import sys
+import os
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.dirname(HERE))
+
+
+def tied_rows(uri, count, seed):
+    """Rows on whole seconds, several per second, some runs longer than a page."""
+    rand = random.Random(seed)
+    rows = make_rows(uri,count,seed=seed)
+    when = datetime(2016,1,1)
+    for i,row in enumerate(rows):
+        if rand.random() < 0.4:
+            when += timedelta(seconds=rand.choice([1,1,2,60]))
+        row["updated"] = when.strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")
+    # One run of equal timestamps longer than a page
+    for row in rows[count // 2:count // 2 + 25]:
+        row["updated"] = rows[count // 2]["updated"]
+    return rows
+
+def check(seeds=range(5), count=2250, limit=20):
+    from h_search import HypothesisSearch
+    upstream = FakeUpstream().start()
+    failures = 0
+    try:
+        for seed in seeds:
+            upstream.rows = []
+            rows = tied_rows(upstream.collection_url(1),count,seed)
+            upstream.add_rows(rows)
+            expected = sorted(row["id"] for row in rows)
+            search = HypothesisSearch(limit=limit,api_url=upstream.url + "/api")
+            for windows in (1,4):
+                found = sorted(row["id"] for row in search.scan(windows=windows))
+                if found != expected:
+                    failures += 1
+                    print("seed %s, %s windows: %s of %s rows (%s missing, %s repeated)" %(
+                          seed,windows,len(found),len(expected),
+                          len(set(expected) - set(found)),len(found) - len(set(found))))
+    finally:
+        upstream.stop()
+    return failures
+
+
+if __name__ == "__main__":
+    failures = check()
+    print("paging %s" % ("failed" if failures else "ok"))
+    sys.exit(1 if failures else 0)
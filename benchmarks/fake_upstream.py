@@ -0,0 +1,217 @@
+"""Local stand-ins for the hypothes.is search API and the NeuroVault image API.
+
+Responses are served from recorded JSON (or generated rows of the same
+shape), after a configurable delay, so routes can be benchmarked without
+touching the live services.
+"""
+from datetime import datetime, timedelta
+import threading
+import random
+import json
+import time
+import zlib
+import re
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+IMAGE_FIELDS = ["cognitive_paradigm_cogatlas","contrast_definition","image_type",
+                "modality","map_type","smoothness_fwhm"]
+ANNOTATED_FIELDS = ["coordinate_space","software_package","number_of_subjects",
+                    "modality","contrast_definition","map_type"]
+USERS = ["vsoch","chrisgorgo","poldrack","jturner","tyarkoni"]
+
+
+def make_images(pk, count, base_url, seed=0):
+    """count NeuroVault image records of collection pk, some fields left empty."""
+    rand = random.Random(seed * 100003 + int(pk))
+    images = []
+    for i in range(count):
+        image_id = int(pk) * 100000 + i
+        image = {"id":image_id,
+                 "name":"Image %s of collection %s" %(i,pk),
+                 "url":"%s/images/%s/" %(base_url,image_id),
+                 "thumbnail":"%s/media/images/%s/glass_brain.png" %(base_url,image_id),
+                 "figure":rand.choice([None,"Figure %s" % (i % 7 + 1)]),
+                 "collection_id":int(pk)}
+        for field in IMAGE_FIELDS:
+            image[field] = None if rand.random() < 0.3 else "%s %s" %(field,rand.randint(0,9))
+        if image["smoothness_fwhm"] is not None:
+            image["smoothness_fwhm"] = round(rand.uniform(2,12),1)
+        images.append(image)
+    return images
+
+def make_rows(uri, count, image_ids=(), seed=0, start=datetime(2016,1,1)):
+    """count hypothes.is search rows annotating uri, oldest first.
+
+    Every other annotation tags one of image_ids, a few are replies.
+    """
+    rand = random.Random("%s-%s" %(seed,uri))
+    prefix = zlib.crc32(uri.encode("utf-8")) & 0xfffff
+    rows = []
+    for i in range(count):
+        updated = start + timedelta(seconds=i * 37 + rand.randint(0,30))
+        field = rand.choice(ANNOTATED_FIELDS)
+        tags = [field]
+        if image_ids and i % 2 == 0:
+            tags.append(str(rand.choice(image_ids)))
+        row = {"id":"%05x-%05d" %(prefix,i),
+               "uri":uri,
+               "user":"acct:%s@hypothes.is" % rand.choice(USERS),
+               "updated":updated.strftime("%Y-%m-%dT%H:%M:%S.%f+00:00"),
+               "created":updated.strftime("%Y-%m-%dT%H:%M:%S.%f+00:00"),
+               "tags":tags,
+               "text":"%s value %s, see **the paper**" %(field,rand.randint(0,99)),
+               "references":[],
+               "document":{"title":["NeuroVault collection %s" % uri]},
+               "target":[{"source":uri,"selector":[
+                   {"type":"TextQuoteSelector","prefix":"before ","exact":field,"suffix":" after"},
+                   {"type":"TextPositionSelector","start":i,"end":i + len(field)}]}]}
+        if rows and i % 5 == 4:
+            row["references"] = [rows[rand.randint(0,len(rows) - 1)]["id"]]
+            row["target"] = []
+        rows.append(row)
+    return rows
+
+
+class FakeUpstream:
+
+    def __init__(self, latency=0.0, jitter=0.0, seed=0):
+        """Annotations and images served by one local HTTP server.
+
+        Every response waits latency seconds, plus up to jitter more.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.seed = seed
+        self.rows = []
+        self.images = dict()
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        host,port = self.server.server_address[:2]
+        return "http://%s:%s" %(host,port)
+
+    def add_collection(self, pk, images=100, annotations=100):
+        """Generate a collection with its images and annotations of its page."""
+        self.images[int(pk)] = make_images(pk,images,self.url,self.seed)
+        image_ids = [image["id"] for image in self.images[int(pk)]]
+        self.add_rows(make_rows(self.collection_url(pk),annotations,image_ids,self.seed))
+
+    def add_rows(self, rows):
+        self.rows.extend(rows)
+        self.rows.sort(key=lambda row: (row["updated"],row["id"]))
+
+    def collection_url(self, pk):
+        return "%s/collections/%s/" %(self.url,pk)
+
+    def load(self, path):
+        """Replay recorded responses, {"<pk>": {"images": [...], "rows": [...]}}.
+
+        Rows are moved to the local collection page URL. Returns the pks.
+        """
+        with open(path,"r") as filey:
+            recorded = json.load(filey)
+        for pk,collection in recorded.items():
+            uri = self.collection_url(pk)
+            self.images[int(pk)] = collection.get("images",[])
+            self.add_rows([dict(row,uri=uri) for row in collection.get("rows",[])])
+        return sorted(int(pk) for pk in recorded)
+
+    def search(self, query):
+        """Rows matching a /api/search query, as hypothes.is pages them."""
+        rows = self.rows
+        if "uri" in query:
+            rows = [row for row in rows if row["uri"] == query["uri"][0]]
+        if "user" in query:
+            user = query["user"][0]
+            rows = [row for row in rows if row["user"] in (user,"acct:%s@hypothes.is" % user)]
+        for tag in query.get("tags",[]):
+            rows = [row for row in rows if tag in row["tags"]]
+        total = len(rows)
+        descending = query.get("order",["desc"])[0] == "desc"
+        if descending:
+            rows = rows[::-1]
+        if "search_after" in query:
+            after = query["search_after"][0]
+            if descending:
+                rows = [row for row in rows if row["updated"] < after]
+            else:
+                rows = [row for row in rows if row["updated"] > after]
+        limit = int(query.get("limit",["20"])[0])
+        return {"total":total,"rows":rows[:limit]}
+
+    def collection_images(self, pk, query):
+        """One page of /api/collections/<pk>/images/."""
+        images = self.images.get(int(pk))
+        if images is None:
+            return None
+        offset = int(query.get("offset",["0"])[0])
+        limit = int(query.get("limit",["100"])[0])
+        following = None
+        if offset + limit < len(images):
+            following = "%s/api/collections/%s/images/?format=json&limit=%s&offset=%s" %(
+                        self.url,pk,limit,offset + limit)
+        return {"count":len(images),"next":following,"previous":None,
+                "results":images[offset:offset + limit]}
+
+    def respond(self, path, query):
+        """(status, JSON body) for a request path."""
+        if path.rstrip("/") == "/api/search":
+            return 200,self.search(query)
+        match = re.match(r"^/api/collections/(\d+)/images/?$",path)
+        if match:
+            page = self.collection_images(match.group(1),query)
+            if page is None:
+                return 404,{"detail":"Not found."}
+            return 200,page
+        # Collection pages and everything else just exist
+        return 200,{}
+
+    def start(self, host="127.0.0.1", port=0):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with upstream.lock:
+                    upstream.requests += 1
+                time.sleep(upstream.latency + random.random() * upstream.jitter)
+                parsed = urlparse(self.path)
+                status,data = upstream.respond(parsed.path,parse_qs(parsed.query))
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type","application/json")
+                self.send_header("Content-Length",str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            do_HEAD = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        self.server = Server((host,port),Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
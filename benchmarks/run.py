@@ -0,0 +1,259 @@
+"""Benchmark the portal against local stand-ins for hypothes.is and NeuroVault.
+
+    python benchmarks/run.py --sizes 10,100,1000,10000 --latency 0.05 --output results.json
+    python benchmarks/run.py --compare results.json
+
+Collections of each size (images and annotations) are generated, or
+replayed from --recorded, and served by a local fake upstream. Routes are
+driven through the Flask test client, sequentially with cold and warm
+caches and then under concurrent load, and the main functions behind them
+are timed on their own. Latency percentiles and throughput are printed and
+written to --output, which a later run can --compare against.
+"""
+from multiprocessing.pool import ThreadPool
+from fake_upstream import FakeUpstream
+import argparse
+import platform
+import tempfile
+import shutil
+import json
+import time
+import sys
+import os
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.dirname(HERE))
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * q / 100.0
+    low = int(position)
+    high = min(low + 1,len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+def summarize(latencies, wall=None, errors=0):
+    """Latency percentiles (ms) and throughput (calls per second)."""
+    if wall is None:
+        wall = sum(latencies)
+    return {"n":len(latencies),
+            "errors":errors,
+            "mean_ms":1000.0 * sum(latencies) / len(latencies) if latencies else None,
+            "p50_ms":1000.0 * percentile(latencies,50) if latencies else None,
+            "p90_ms":1000.0 * percentile(latencies,90) if latencies else None,
+            "p99_ms":1000.0 * percentile(latencies,99) if latencies else None,
+            "max_ms":1000.0 * max(latencies) if latencies else None,
+            "throughput":len(latencies) / wall if wall else None}
+
+def timed(call, repeat, setup=None):
+    """Time repeat calls, setup() (not timed) makes a fresh argument for each."""
+    latencies = []
+    for i in range(repeat):
+        args = (setup(),) if setup is not None else ()
+        start = time.time()
+        call(*args)
+        latencies.append(time.time() - start)
+    return summarize(latencies)
+
+def get(client, path):
+    response = client.get(path)
+    # Streamed responses are only produced as they are read
+    body = response.get_data()
+    if response.status_code >= 400:
+        raise RuntimeError("%s returned %s" %(path,response.status_code))
+    return body
+
+def load(app, paths, requests, concurrency):
+    """Send requests spread over paths from concurrency threads."""
+    def one(path):
+        start = time.time()
+        try:
+            get(app.test_client(),path)
+            return time.time() - start,False
+        except Exception:
+            return time.time() - start,True
+
+    pool = ThreadPool(concurrency)
+    try:
+        start = time.time()
+        results = pool.map(one,[paths[i % len(paths)] for i in range(requests)])
+        wall = time.time() - start
+    finally:
+        pool.close()
+    latencies = [latency for latency,failed in results if not failed]
+    return summarize(latencies,wall,errors=sum(failed for latency,failed in results))
+
+
+class Benchmark:
+
+    def __init__(self, args):
+        """Start the fake upstream and point a fresh portal at it."""
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="nva-bench-")
+        self.upstream = FakeUpstream(latency=args.latency,jitter=args.jitter).start()
+
+        # Settings are read when the portal modules are first imported
+        os.environ.update({"NVA_HYPOTHESIS_URL":self.upstream.url,
+                           "NVA_NEUROVAULT_URL":self.upstream.url,
+                           "NVA_CACHE_DIR":os.path.join(self.workdir,"cache"),
+                           "NVA_COMPLETENESS_SNAPSHOT":os.path.join(self.workdir,"completeness"),
+                           "NVA_ANNOTATION_SOURCE":"live",
+                           "NVA_WARMUP_ENABLED":"0"})
+        import index
+        self.index = index
+        self.sizes = [int(size) for size in args.sizes.split(",")]
+        self.make_catalog()
+
+    def make_catalog(self):
+        """Recorded collections, one per size, then small ones filling the index page."""
+        import pandas
+        from catalog import CollectionCatalog, write_snapshot
+        self.labels = dict()
+        if self.args.recorded:
+            for pk in self.upstream.load(self.args.recorded):
+                self.labels[pk] = "pk=%s" % pk
+        first = max([0] + list(self.labels)) + 1
+        for pk,size in enumerate(self.sizes,first):
+            self.upstream.add_collection(pk,images=size,annotations=size)
+            self.labels[pk] = "size=%s" % size
+        pks = sorted(self.labels)
+        for pk in range(first + len(self.sizes),first + len(self.sizes) + self.args.collections):
+            self.upstream.add_collection(pk,images=10,annotations=10)
+            pks.append(pk)
+
+        collections = pandas.DataFrame({
+            "collection_id":pks,
+            "name":["Benchmark collection %s" % pk for pk in pks],
+            "url":[self.upstream.collection_url(pk) for pk in pks],
+            "DOI":["10.0000/bench.%s" % pk for pk in pks],
+            "coordinate_space":[None if pk % 3 else "MNI" for pk in pks],
+            "software_package":[None if pk % 2 else "FSL" for pk in pks],
+            "used_motion_correction":[None for pk in pks],
+            "number_of_subjects":[float(pk % 40) if pk % 4 else float("nan") for pk in pks],
+            "journal_name":["NeuroImage" for pk in pks],
+            "authors":["A. Author, B. Author" for pk in pks]})
+        path = os.path.join(self.workdir,"catalog")
+        write_snapshot(collections,path)
+        self.index.catalog = CollectionCatalog(path,pickle=None)
+
+    def clear_caches(self):
+        self.index.annotation_cache.clear()
+        self.index.image_cache.clear()
+
+    def collection_data(self, pk):
+        """Collection row, images and annotations, fetched once."""
+        index = self.index
+        collection = index.get_collections(pk=pk)
+        url = collection["url"].tolist()[0]
+        images = index.get_collection_images(pk)
+        annots = index.get_annotations(url,collection.columns)
+        return collection,images,annots
+
+    def micro(self):
+        from hypothesis import HypothesisRawAnnotation, HypothesisStream
+        index = self.index
+        app = index.app
+        repeat = self.args.repeat
+        results = dict()
+
+        results["get_collections"] = timed(lambda: index.get_collections(),repeat)
+        results["get_collections[index columns]"] = timed(
+            lambda: index.get_collections(columns=index.INDEX_COLUMNS),repeat)
+        with app.test_request_context("/"):
+            results["main_page"] = timed(index.main_page,repeat)
+            results["main_page[uncached]"] = timed(index.main_page,repeat,setup=index.index_pages.clear)
+
+        for pk,label in sorted(self.labels.items()):
+            collection,images,annots = self.collection_data(pk)
+            fields = lambda: index.get_important_fields(images,collection)
+            results["update_fields[%s]" % label] = timed(
+                lambda fields: index.update_fields(annots,fields),repeat,setup=fields)
+
+            rows = [row for row in self.upstream.rows if row["uri"] == self.upstream.collection_url(pk)]
+            results["HypothesisRawAnnotation[%s]" % label] = timed(
+                lambda: [HypothesisRawAnnotation(row) for row in rows],repeat)
+            results["HypothesisRawAnnotation.records[%s]" % label] = timed(
+                lambda: HypothesisRawAnnotation.records(rows),repeat)
+
+        with app.test_request_context("/stream.alt"):
+            results["make_alt_stream"] = timed(
+                lambda: HypothesisStream(limit=200).make_alt_stream(),repeat)
+        return results
+
+    def routes(self):
+        index = self.index
+        client = index.app.test_client()
+        repeat = self.args.repeat
+        results = dict()
+        paths = ["/"]
+        for pk in sorted(self.labels):
+            paths.extend(["/collection/%s" % pk,"/annotate/%s" % pk])
+        get(client,"/")
+        for path in paths:
+            results["GET %s cold" % path] = timed(partial_get(client,path),repeat,setup=self.clear_caches)
+            results["GET %s warm" % path] = timed(partial_get(client,path),repeat)
+        for concurrency in self.args.concurrency:
+            self.clear_caches()
+            results["load c=%s" % concurrency] = load(index.app,paths,self.args.requests,concurrency)
+        return results
+
+    def run(self):
+        results = {"micro":self.micro(),"routes":self.routes()}
+        results["upstream_requests"] = self.upstream.requests
+        return results
+
+    def close(self):
+        self.upstream.stop()
+        shutil.rmtree(self.workdir,ignore_errors=True)
+
+
+def partial_get(client, path):
+    return lambda *args: get(client,path)
+
+def report(results, previous=None):
+    """Print one line per benchmark, with the p50 change against previous."""
+    print("%-48s %8s %10s %10s %10s %10s" %("benchmark","n","p50 ms","p90 ms","p99 ms","per s"))
+    for group in ("micro","routes"):
+        for name in sorted(results[group]):
+            result = results[group][name]
+            line = "%-48s %8s %10.2f %10.2f %10.2f %10.1f" %(name,result["n"],result["p50_ms"] or 0,
+                    result["p90_ms"] or 0,result["p99_ms"] or 0,result["throughput"] or 0)
+            before = (previous or {}).get(group,{}).get(name)
+            if before and before.get("p50_ms") and result["p50_ms"]:
+                line += " %+6.1f%%" %(100.0 * (result["p50_ms"] - before["p50_ms"]) / before["p50_ms"])
+            if result["errors"]:
+                line += " (%s errors)" % result["errors"]
+            print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the annotation portal offline")
+    parser.add_argument("--sizes",default="10,100,1000",help="images and annotations per benchmarked collection")
+    parser.add_argument("--collections",type=int,default=200,help="extra small collections in the catalog")
+    parser.add_argument("--latency",type=float,default=0.02,help="seconds the fake upstream waits per request")
+    parser.add_argument("--jitter",type=float,default=0.0,help="up to this many extra seconds per request")
+    parser.add_argument("--recorded",default=None,help="JSON of recorded rows and images to replay")
+    parser.add_argument("--repeat",type=int,default=20,help="calls per sequential benchmark")
+    parser.add_argument("--requests",type=int,default=200,help="requests per load test")
+    parser.add_argument("--concurrency",type=int,nargs="+",default=[1,8,32])
+    parser.add_argument("--output",default=None,help="write results to this JSON file")
+    parser.add_argument("--compare",default=None,help="results JSON of an earlier run")
+    args = parser.parse_args()
+
+    benchmark = Benchmark(args)
+    try:
+        results = benchmark.run()
+    finally:
+        benchmark.close()
+    results["config"] = dict(vars(args),python=platform.python_version(),time=time.time())
+
+    previous = None
+    if args.compare:
+        with open(args.compare,"r") as filey:
+            previous = json.load(filey)
+    report(results,previous)
+    if args.output:
+        with open(args.output,"w") as filey:
+            json.dump(results,filey,indent=1,sort_keys=True)
@@ -0,0 +1,84 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache:
+
+    def __init__(self, maxsize=128, ttl=300, stale=0):
+        """Bounded LRU cache whose entries expire after ttl seconds.
+
+        For stale seconds after expiry an entry is still served, while it
+        is reloaded in the background (stale-while-revalidate).
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale = stale
+        self.data = OrderedDict()
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refresh_errors = 0
+
+    def get(self, key, load):
+        """Return the cached value for key, calling load() on a miss."""
+        with self.lock:
+            entry = self.data.pop(key,None)
+            if entry is not None:
+                value,stored = entry
+                age = time.time() - stored
+                if age <= self.ttl + self.stale:
+                    # Most recently used entries live at the end
+                    self.data[key] = entry
+                    if age <= self.ttl:
+                        self.hits += 1
+                        return value
+                    self.stale_hits += 1
+                    if key not in self.refreshing:
+                        self.refreshing.add(key)
+                        thread = threading.Thread(target=self.refresh,args=(key,load))
+                        thread.daemon = True
+                        thread.start()
+                    return value
+            self.misses += 1
+        value = load()
+        self.set(key,value)
+        return value
+
+    def refresh(self, key, load):
+        """Reload one entry, keeping the stale value if loading fails."""
+        try:
+            self.set(key,load())
+        except Exception:
+            with self.lock:
+                self.refresh_errors += 1
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key,None)
+            self.data[key] = (value,time.time())
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.stale_hits + self.misses
+            return {"size":len(self.data),
+                    "maxsize":self.maxsize,
+                    "hits":self.hits,
+                    "stale_hits":self.stale_hits,
+                    "misses":self.misses,
+                    "evictions":self.evictions,
+                    "refresh_errors":self.refresh_errors,
+                    "hit_rate":float(self.hits + self.stale_hits) / requests if requests else None}
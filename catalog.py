@@ -0,0 +1,186 @@
+from collections import OrderedDict
+import threading
+import numpy
+import json
+import time
+import sys
+import os
+import pandas
+
+# Columns that are never shown in the portal
+PRIVATE_COLUMNS = ["owner","add_date","contributors"]
+
+# Default locations of the legacy pickle and the columnar snapshot
+CATALOG_PICKLE = "static/data/nv_collections.pkl"
+CATALOG_SNAPSHOT = "static/data/nv_collections"
+
+# Snapshot layout: one .npy file per column (text columns also get a
+# .null.npy mask), described by manifest.json, which is written last.
+MANIFEST = "manifest.json"
+
+
+def published(collections):
+    """Keep only published (DOI) collections, without private columns."""
+    collections = collections[collections["DOI"].isnull()==False]
+    return collections.drop(PRIVATE_COLUMNS,axis=1)
+
+def to_text(value):
+    if isinstance(value,bytes):
+        return value.decode('utf-8')
+    return u"{0}".format(value)
+
+def is_flag(values, nulls):
+    """True when every present value of an object column is a boolean."""
+    present = [value for value,null in zip(values,nulls) if not null]
+    return len(present) > 0 and all(isinstance(value,(bool,numpy.bool_)) for value in present)
+
+def frame_to_columns(collections):
+    """Split a frame into (name, values, nulls) numpy columns.
+
+    Object columns are stored as fixed width unicode (or as booleans when
+    they only hold True/False) so they can be memory-mapped, with a
+    boolean mask remembering the missing values.
+    """
+    columns = []
+    for name in collections.columns:
+        values = collections[name].values
+        nulls = None
+        if values.dtype == object:
+            nulls = numpy.asarray(pandas.isnull(values),dtype=bool)
+            if is_flag(values,nulls):
+                values = numpy.array([False if null else bool(value) for value,null in zip(values,nulls)],dtype=bool)
+            else:
+                text = [u"" if null else to_text(value) for value,null in zip(values,nulls)]
+                values = numpy.array(text,dtype=numpy.unicode_)
+        columns.append((name,values,nulls))
+    return columns
+
+def write_snapshot(collections, path):
+    """Write a frame as a memory-mappable columnar snapshot."""
+    if not os.path.exists(path):
+        os.makedirs(path)
+    # Files are versioned so workers holding the old mmaps are not disturbed
+    stamp = "%d" % int(time.time() * 1000)
+    manifest = {"rows":len(collections),"columns":[]}
+    for i,(name,values,nulls) in enumerate(frame_to_columns(collections)):
+        column = {"name":name,"file":"%s-%03d.npy" % (stamp,i),"nulls":None}
+        numpy.save(os.path.join(path,column["file"]),values)
+        if nulls is not None:
+            column["nulls"] = "%s-%03d.null.npy" % (stamp,i)
+            numpy.save(os.path.join(path,column["nulls"]),nulls)
+        manifest["columns"].append(column)
+
+    tmp = os.path.join(path,MANIFEST + ".tmp")
+    with open(tmp,"w") as filey:
+        json.dump(manifest,filey,indent=1)
+    os.rename(tmp,os.path.join(path,MANIFEST))
+
+    # Old column files can go, open mmaps keep their inode alive
+    keep = set([MANIFEST])
+    for column in manifest["columns"]:
+        keep.update([column["file"],column["nulls"]])
+    for filename in os.listdir(path):
+        if filename.endswith(".npy") and filename not in keep:
+            os.remove(os.path.join(path,filename))
+    return manifest
+
+def read_snapshot(path):
+    """Open every column of a snapshot memory-mapped."""
+    with open(os.path.join(path,MANIFEST),"r") as filey:
+        manifest = json.load(filey)
+    columns = []
+    for column in manifest["columns"]:
+        values = numpy.load(os.path.join(path,column["file"]),mmap_mode="r")
+        nulls = None
+        if column["nulls"]:
+            nulls = numpy.load(os.path.join(path,column["nulls"]),mmap_mode="r")
+        columns.append((column["name"],values,nulls))
+    return columns
+
+def convert_pickle(pkl=CATALOG_PICKLE, path=CATALOG_SNAPSHOT):
+    """Convert the legacy pandas pickle into a published catalog snapshot."""
+    return write_snapshot(published(pandas.read_pickle(pkl)),path)
+
+
+class CollectionCatalog:
+
+    def __init__(self, path=CATALOG_SNAPSHOT, pickle=CATALOG_PICKLE):
+        """Process-wide view of the NeuroVault collection catalog.
+
+        Columns are read from the snapshot at path, falling back to the
+        legacy pickle when no snapshot has been written yet.
+        """
+        self.path = path
+        self.pickle = pickle
+        self.lock = threading.Lock()
+        # (version, columns, collection_id -> row position), swapped as one
+        self.snapshot = (None, None, {})
+
+    def source(self):
+        manifest = os.path.join(self.path,MANIFEST)
+        if os.path.exists(manifest) or self.pickle is None:
+            return manifest
+        return self.pickle
+
+    def load(self, source):
+        """Open the catalog columns and index rows by collection_id."""
+        if source == self.pickle:
+            columns = frame_to_columns(published(pandas.read_pickle(source)))
+        else:
+            columns = read_snapshot(self.path)
+        columns = OrderedDict((name,(values,nulls)) for name,values,nulls in columns)
+        index = dict((int(pk),idx) for idx,pk in enumerate(columns["collection_id"][0]))
+        return columns,index
+
+    def refresh(self):
+        """Reload the catalog only when its source changed on disk."""
+        source = self.source()
+        version = (source,os.path.getmtime(source))
+        snapshot = self.snapshot
+        if snapshot[0] != version:
+            with self.lock:
+                snapshot = self.snapshot
+                if snapshot[0] != version:
+                    columns,index = self.load(source)
+                    snapshot = (version,columns,index)
+                    self.snapshot = snapshot
+        return snapshot
+
+    @property
+    def version(self):
+        """Identifier of the currently loaded catalog (source and mtime)."""
+        return self.refresh()[0]
+
+    def frame(self, columns, names=None, rows=None):
+        """Materialize only the requested columns (and row slice) as a frame."""
+        if names is None:
+            names = list(columns.keys())
+        if rows is None:
+            rows = slice(None)
+        data = OrderedDict()
+        for name in names:
+            values,nulls = columns[name]
+            if nulls is not None:
+                # Text comes back as unicode and flags as bool, missing as None
+                values = values[rows].astype(object)
+                values[numpy.asarray(nulls[rows])] = None
+            else:
+                values = numpy.array(values[rows])
+            data[name] = values
+        return pandas.DataFrame(data,columns=names)
+
+    def get(self, pk=None, columns=None):
+        """Return all collections, or a one-row frame for collection pk."""
+        version,data,index = self.refresh()
+        if not pk:
+            return self.frame(data,columns)
+        idx = index.get(int(pk))
+        if idx is None:
+            return self.frame(data,columns,slice(0,0))
+        return self.frame(data,columns,slice(idx,idx+1))
+
+
+if __name__ == "__main__":
+    # python catalog.py [nv_collections.pkl] [snapshot directory]
+    manifest = convert_pickle(*sys.argv[1:3])
+    print("Wrote %s collections, %s columns" %(manifest["rows"],len(manifest["columns"])))
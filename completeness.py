@@ -0,0 +1,115 @@
+from index import get_collections, fetch_collection_images
+from catalog import write_snapshot
+import argparse
+import logging
+import numpy
+import pandas
+import os
+import settings
+import upstream
+
+logger = logging.getLogger(__name__)
+
+# Fields counted by get_important_fields, collection fields by catalog column
+IMAGE_FIELDS = ["figure","cognitive_paradigm_cogatlas","contrast_definition",
+                "image_type","modality","name","map_type","smoothness_fwhm",
+                "thumbnail","url","id"]
+COLLECTION_FIELDS = ["coordinate_space","software_package","used_motion_correction",
+                     "number_of_subjects","name","url","journal_name","authors",
+                     "collection_id"]
+
+
+# Important fields of every image of one collection, None when it fails
+def collection_images(pk):
+    try:
+        images = fetch_collection_images(pk)
+    except Exception:
+        logger.exception("Images of collection %s could not be fetched",pk)
+        return None
+    for image in images:
+        image["collection_id"] = int(pk)
+    return images
+
+def fetch_image_table(collection_ids, table=None, workers=settings.COMPLETENESS_WORKERS):
+    """Image fields of every collection, one row per image.
+
+    Collections already in table are not fetched again.
+    """
+    frames = []
+    if table is not None:
+        table = table[table["collection_id"].isin(collection_ids)]
+        frames.append(table)
+        done = set(table["collection_id"].tolist())
+        collection_ids = [pk for pk in collection_ids if pk not in done]
+    # Each collection pages through its images on the "pages" pool
+    results = upstream.imap(collection_images,collection_ids,workers=workers,pool="collections")
+    for images in results:
+        if images:
+            frames.append(pandas.DataFrame(images,columns=IMAGE_FIELDS + ["collection_id"]))
+    if not frames:
+        return pandas.DataFrame(columns=IMAGE_FIELDS + ["collection_id"])
+    return pandas.concat(frames,ignore_index=True)
+
+def completeness_index(collections, images):
+    """Missing and present field counts per collection, as get_important_fields counts them.
+
+    Collections without any fetched image only count their own fields.
+    Every field also gets a missing_<field> column, so curators can ask
+    which collections lack a particular field.
+    """
+    image_missing = images[IMAGE_FIELDS].isnull().astype(numpy.int64)
+    image_missing["collection_id"] = images["collection_id"].values.astype(numpy.int64)
+    by_collection = image_missing.groupby("collection_id").sum()
+    counts = images.groupby("collection_id").size()
+
+    collection_missing = collections[COLLECTION_FIELDS].isnull().astype(numpy.int64)
+    collection_missing.index = collections["collection_id"].values.astype(numpy.int64)
+
+    ids = collection_missing.index
+    by_collection = by_collection.reindex(ids).fillna(0).astype(numpy.int64)
+    counts = counts.reindex(ids).fillna(0).astype(numpy.int64)
+
+    missing = collection_missing.sum(axis=1) + by_collection.sum(axis=1)
+    total = len(COLLECTION_FIELDS) + counts * len(IMAGE_FIELDS)
+
+    index = pandas.DataFrame({"collection_id":ids.values,
+                              "images":counts.values,
+                              "missing":missing.values,
+                              "present":(total - missing).values},
+                             columns=["collection_id","images","missing","present"])
+    for field in COLLECTION_FIELDS:
+        index["missing_%s" % field] = collection_missing[field].values
+    for field in IMAGE_FIELDS:
+        column = "missing_%s" % field
+        if column in index:
+            index[column] += by_collection[field].values
+        else:
+            index[column] = by_collection[field].values
+    return index
+
+def build(path=settings.COMPLETENESS_SNAPSHOT, image_table=settings.IMAGE_TABLE,
+          refresh=False, workers=settings.COMPLETENESS_WORKERS):
+    """Fetch missing image fields, then write the completeness snapshot."""
+    collections = get_collections(columns=COLLECTION_FIELDS)
+    table = None
+    if not refresh and os.path.exists(image_table):
+        table = pandas.read_pickle(image_table)
+    ids = collections["collection_id"].astype(numpy.int64).tolist()
+    images = fetch_image_table(ids,table,workers=workers)
+
+    directory = os.path.dirname(image_table)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    images.to_pickle(image_table)
+    return write_snapshot(completeness_index(collections,images),path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the metadata completeness index")
+    parser.add_argument("--output",default=settings.COMPLETENESS_SNAPSHOT)
+    parser.add_argument("--images",default=settings.IMAGE_TABLE,help="cached image table")
+    parser.add_argument("--refresh",action="store_true",help="fetch the images of every collection again")
+    parser.add_argument("--workers",type=int,default=settings.COMPLETENESS_WORKERS)
+    args = parser.parse_args()
+    manifest = build(args.output,args.images,refresh=args.refresh,workers=args.workers)
+    print("Wrote completeness of %s collections to %s" %(manifest["rows"],args.output))
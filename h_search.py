@@ -0,0 +1,110 @@
+from datetime import datetime
+from functools import partial
+import upstream
+import settings
+
+API_URL = settings.HYPOTHESIS_URL + '/api'
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# Window edges are written like the updated values of rows, so comparing
+# strings agrees with the server comparing times
+EDGE_FORMAT = TIME_FORMAT + ".000000+00:00"
+
+
+class HypothesisSearch:
+
+    def __init__(self, params=None, limit=200, api_url=API_URL):
+        """A Hypothesis search, paged on the updated cursor (search_after)."""
+        self.params = dict(params or {})
+        self.limit = limit
+        self.search_url = api_url + '/search'
+
+    def fetch(self, search_after=None, order="asc", limit=None):
+        """Get one page of rows sorted by updated."""
+        params = dict(self.params)
+        params.update({"sort":"updated","order":order,"limit":limit or self.limit})
+        if search_after is not None:
+            params["search_after"] = search_after
+        response = upstream.get(self.search_url,params=params,stream=True)
+        meta,rows = upstream.stream_json(response,"rows")
+        return list(rows)
+
+    def pages(self, search_after=None, until=None):
+        """Yield pages of rows updated after search_after, up to until.
+
+        The next page is requested while the current one is processed.
+        """
+        cursor = search_after
+        limit = self.limit
+        rows = self.fetch(cursor)
+        seen = set()
+        while rows:
+            last = rows[-1]["updated"]
+            done = len(rows) < limit or (until is not None and last > until)
+            following = None
+            if not done:
+                # search_after is exclusive, so rows sharing the last timestamp
+                # may not all be in this page: go on from the last earlier one
+                earlier = [row["updated"] for row in rows if row["updated"] < last]
+                if earlier:
+                    cursor = earlier[-1]
+                    limit = self.limit
+                else:
+                    # The whole page is one timestamp, ask for more of it
+                    limit *= 2
+                following = upstream.prefetch(partial(self.fetch,cursor,limit=limit))
+            # Rows after the cursor come back again, each is yielded once
+            page = [row for row in rows if row["id"] not in seen and
+                                           (until is None or row["updated"] <= until)]
+            seen = set(row["id"] for row in rows if cursor is None or row["updated"] > cursor)
+            if page:
+                yield page
+            rows = following.get() if following is not None else []
+
+    def rows(self, search_after=None, until=None):
+        for page in self.pages(search_after,until):
+            for row in page:
+                yield row
+
+    def bounds(self):
+        """Oldest and newest updated timestamps matching the search."""
+        first = self.fetch(order="asc",limit=1)
+        if not first:
+            return None
+        last = self.fetch(order="desc",limit=1)
+        return first[0]["updated"],last[0]["updated"]
+
+    def windows(self, count, search_after=None):
+        """Split the search into count (search_after, until] windows of equal duration.
+
+        A row updated exactly at an edge belongs to the earlier window.
+        """
+        bounds = self.bounds()
+        if bounds is None:
+            return []
+        start = parse_time(search_after or bounds[0])
+        end = parse_time(bounds[1])
+        if count < 2 or end <= start:
+            return [(search_after,None)]
+        step = (end - start) / count
+        edges = [(start + step * i).strftime(EDGE_FORMAT) for i in range(1,count)]
+        return list(zip([search_after] + edges,edges + [None]))
+
+    def scan(self, search_after=None, windows=1):
+        """Yield every row in updated order, fetching date windows concurrently."""
+        if windows < 2:
+            for row in self.rows(search_after):
+                yield row
+            return
+        chunks = upstream.imap(self.window_rows,self.windows(windows,search_after),workers=windows)
+        for rows in chunks:
+            for row in rows:
+                yield row
+
+    def window_rows(self, window):
+        return list(self.rows(*window))
+
+
+def parse_time(updated):
+    return datetime.strptime(updated[0:19],TIME_FORMAT)
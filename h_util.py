@@ -1,7 +1,13 @@
-import requests, json, types, re, operator, traceback
+import upstream, json, types, re, operator, traceback, threading, base64, time, bisect
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from calendar import timegm
 from markdown import markdown
+from h_search import HypothesisSearch
+from cache import TTLCache
+from flask import Response
+import settings
+import timing
 import urlparse
 
 try:
@@ -9,44 +15,185 @@ try:
 except ImportError:
     from urllib import urlencode
 
+# create_annotation arguments, in make_annotation_payload order
+PAYLOAD_ARGS = ('url', 'start_pos', 'end_pos', 'prefix', 'quote', 'suffix', 'text', 'tags', 'link')
 
-class HypothesisUtils:
+def tag_key(tags):
+    return frozenset(t.strip() for t in tags or [])
+
+
+def token_expiry(token, ttl=settings.HYPOTHESIS_TOKEN_TTL):
+    """Expiry time of a JWT token, or ttl from now if it cannot be read."""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(str(payload)))['exp'])
+    except Exception:
+        return time.time() + ttl
+
+
+class TokenRefresh:
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+class HypothesisTokenProvider:
+
+    def __init__(self, margin=settings.HYPOTHESIS_TOKEN_MARGIN):
+        """Process-wide auth tokens, one login per user.
+
+        Tokens are refreshed in the background once they are within margin
+        seconds of expiry, and only one login per user runs at a time.
+        """
+        self.margin = margin
+        self.tokens = {}      # (app_url, username) -> (token, expires)
+        self.refreshing = {}  # (app_url, username) -> TokenRefresh
+        self.lock = threading.Lock()
+
+    def get(self, utils, invalid=None):
+        """Token for the user of utils, invalid is a token the API just rejected."""
+        key = (utils.app_url, utils.username)
+        while True:
+            with self.lock:
+                token, expires = self.tokens.get(key, (None, 0))
+                if token is not None and token == invalid:
+                    token, expires = None, 0
+                now = time.time()
+                if token is not None and now < expires - self.margin:
+                    return token
+                refresh = self.refreshing.get(key)
+                if refresh is None:
+                    refresh = self.refreshing[key] = TokenRefresh()
+                    thread = threading.Thread(target=self.refresh, args=(key, utils, refresh))
+                    thread.daemon = True
+                    thread.start()
+                # Still valid, keep using it while the new one is fetched
+                if token is not None and now < expires:
+                    return token
+            refresh.done.wait()
+            if refresh.error is not None:
+                raise refresh.error
+            invalid = None
+
+    def refresh(self, key, utils, refresh):
+        try:
+            token = utils.fetch_token()
+            with self.lock:
+                self.tokens[key] = (token, token_expiry(token))
+        except Exception as e:
+            refresh.error = e
+        finally:
+            with self.lock:
+                self.refreshing.pop(key, None)
+            refresh.done.set()
+
+token_provider = HypothesisTokenProvider()
+
+
+class UserActivity:
+
+    def __init__(self, half_life=settings.USER_ACTIVITY_HALF_LIFE, max_seen=100000):
+        """Time-decayed number of annotations per user, fed from fetched rows.
+
+        Each annotation counts once, and counts half as much for every
+        half_life seconds it is older than the newest annotation seen, so
+        old data still ranks users by how recently they were active.
+        """
+        self.half_life = half_life
+        self.max_seen = max_seen
+        self.scores = {}           # user -> (score, as of, annotations)
+        self.seen = OrderedDict()  # ids of the annotations counted
+        self.newest = None         # updated time of the newest annotation seen
+        self.lock = threading.Lock()
+
+    def decay(self, seconds):
+        return 0.5 ** (float(seconds) / self.half_life)
+
+    def add(self, raw):
+        when = timegm(datetime.strptime(raw.updated, "%Y-%m-%dT%H:%M:%S").timetuple())
+        with self.lock:
+            if raw.id in self.seen:
+                return
+            self.seen[raw.id] = True
+            while len(self.seen) > self.max_seen:
+                self.seen.popitem(last=False)
+            self.newest = when if self.newest is None else max(self.newest, when)
+            score, at, count = self.scores.get(raw.user, (0.0, when, 0))
+            latest = max(at, when)
+            self.scores[raw.user] = (score * self.decay(latest - at) + self.decay(latest - when), latest, count + 1)
+
+    def add_rows(self, rows):
+        for row in rows:
+            self.add(HypothesisRawAnnotation(row))
+
+    def empty(self):
+        return len(self.scores) == 0
+
+    def ranking(self, limit=settings.USER_ACTIVITY_LIMIT):
+        """(user, count) pairs as get_active_users returns them, ranked by decayed activity."""
+        with self.lock:
+            newest = self.newest
+            users = [(user, score * self.decay(newest - at), count) for user, (score, at, count) in self.scores.items()]
+        users.sort(key=operator.itemgetter(0))
+        users.sort(key=operator.itemgetter(1,2), reverse=True)
+        return [(user, count) for user, score, count in users[0:limit]]
+
+user_activity = UserActivity()
+
+# Rendered markdown text and tag HTML of stream annotations
+html_cache = TTLCache(maxsize=settings.HTML_CACHE_SIZE, ttl=float('inf'))
+
+
+class HypothesisUtils(object):
     def __init__(self, username=None, password=None):
-        self.app_url = 'https://hypothes.is/app'
-        self.api_url = 'https://hypothes.is/api'
-        self.query_url = 'https://hypothes.is/api/search?{query}'
-        self.anno_url = 'https://hypothes.is/a'
+        self.app_url = settings.HYPOTHESIS_URL + '/app'
+        self.api_url = settings.HYPOTHESIS_URL + '/api'
+        self.query_url = settings.HYPOTHESIS_URL + '/api/search?{query}'
+        self.anno_url = settings.HYPOTHESIS_URL + '/a'
         self.via_url = 'https://via.hypothes.is'
         self.username = username
         self.password = password
 
+    @property
+    def token(self):
+        """Auth token shared by every instance for this user."""
+        return token_provider.get(self)
+
     def login(self):
+        """Make sure a token is cached for this user, logging in if needed."""
+        return token_provider.get(self)
+
+    def fetch_token(self):
         """Request an assertion, exchange it for an auth token."""
         # https://github.com/rdhyee/hypothesisapi 
-        r = requests.get(self.app_url)
+        r = upstream.get(self.app_url)
         cookies = r.cookies
         payload = {"username":self.username,"password":self.password}
         self.csrf_token = cookies['XSRF-TOKEN']
         data = json.dumps(payload)
         headers = {'content-type':'application/json;charset=UTF-8', 'x-csrf-token': self.csrf_token}
-        r = requests.post(url=self.app_url  + "?__formid__=login", data=data, cookies=cookies, headers=headers)
+        r = upstream.post(url=self.app_url  + "?__formid__=login", data=data, cookies=cookies, headers=headers)
         url = self.api_url + "/token?" + urlencode({'assertion':self.csrf_token})
-        r = (requests.get(url=url,
+        r = (upstream.get(url=url,
                          cookies=cookies, headers=headers))
-        self.token =  r.content
-
-    def search_all(self):
-        """Get all annotations."""
-        params = {'limit':200, 'offset':0 }
-        while True:
-            h_url = self.query_url.format(query=urlencode(params))
-            r = requests.get(h_url).json()
-            rows = r.get('rows')
-            params['offset'] += len(rows)
-            if len(rows) is 0:
+        return r.content
+
+    def post_annotation(self, data, retries=None):
+        """POST an annotation, logging in again once if the token is refused."""
+        token = self.token
+        for attempt in range(2):
+            headers = {'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json;charset=utf-8' }
+            r = upstream.post(self.api_url + '/annotations', headers=headers, data=data, retries=retries)
+            if r.status_code != 401:
                 break
-            for row in rows:
-                yield row
+            token = token_provider.get(self, invalid=token)
+        return r
+
+    def search_all(self, search_after=None, windows=1):
+        """Get all annotations (updated after search_after), oldest update first."""
+        search = HypothesisSearch(api_url=self.api_url)
+        return search.scan(search_after=search_after,windows=windows)
 
     def make_annotation_payload(self, url, start_pos, end_pos, prefix, quote, suffix, text, tags, link):
         """Create JSON payload for API call."""
@@ -89,16 +236,68 @@ class HypothesisUtils:
     def create_annotation(self, url=None, start_pos=None, end_pos=None, prefix=None, 
                quote=None, suffix=None, text=None, tags=None, link=None):
         """Call API with token and payload."""
-        headers = {'Authorization': 'Bearer ' + self.token, 'Content-Type': 'application/json;charset=utf-8' }
         payload = self.make_annotation_payload(url, start_pos, end_pos, prefix, quote, suffix, text, tags, link)
         data = json.dumps(payload, ensure_ascii=False)
-        r = requests.post(self.api_url + '/annotations', headers=headers, data=data)
-        return r
+        return self.post_annotation(data)
+
+    def create_annotations(self, specs, workers=8, rate=5.0, skip_existing=True):
+        """Create annotations for an iterable of create_annotation argument dicts.
+
+        Posts run concurrently under an adaptive rate limit, and a result
+        dict (spec, status, id, error) is yielded for each spec, in order.
+        With skip_existing, a spec whose url already has an annotation by
+        this user with the same tags is skipped, so an interrupted load can
+        simply be run again.
+        """
+        limiter = upstream.AdaptiveRateLimiter(rate)
+        existing = {}  # url -> tag sets already annotated by this user
+        lock = threading.Lock()
+
+        def known(url):
+            with lock:
+                if url in existing:
+                    return existing[url]
+            params = {'uri':url, 'user':'acct:' + self.username + '@hypothes.is'}
+            tags = set(tag_key(row.get('tags')) for row in HypothesisSearch(params, api_url=self.api_url).rows())
+            with lock:
+                return existing.setdefault(url, tags)
+
+        def create(spec):
+            result = {'spec':spec, 'status':'failed', 'id':None, 'error':None}
+            try:
+                key = tag_key(spec.get('tags'))
+                if skip_existing and key in known(spec.get('url')):
+                    result['status'] = 'skipped'
+                    return result
+                payload = self.make_annotation_payload(*[spec.get(arg) for arg in PAYLOAD_ARGS])
+                data = json.dumps(payload, ensure_ascii=False)
+                # Retried here rather than by the client, so the limiter sees every 429
+                for attempt in range(upstream.client.retries + 1):
+                    limiter.acquire()
+                    r = self.post_annotation(data, retries=0)
+                    limiter.update(r)
+                    if r.status_code != 429 or attempt >= upstream.client.retries:
+                        break
+                    r.close()
+                    time.sleep(upstream.client.delay(attempt, r))
+                if r.status_code < 400:
+                    result['status'] = 'created'
+                    result['id'] = r.json().get('id')
+                    if skip_existing:
+                        with lock:
+                            existing[spec.get('url')].add(key)
+                else:
+                    result['error'] = '%s %s' % (r.status_code, r.text[0:200])
+            except Exception as e:
+                result['error'] = str(e)
+            return result
+
+        return upstream.imap(create, specs, workers=workers)
 
     def call_search_api(self, args={'limit':200}):
         """Call search API with dictionary of params."""
         h_url = self.query_url.format(query=urlencode(args))
-        json = requests.get(h_url).json()
+        json = upstream.get(h_url).json()
         return json
 
     def get_active_users(self):
@@ -152,21 +351,27 @@ class HypothesisUtils:
 
 class HypothesisStream:
 
-    def __init__(self, limit=None):
+    def __init__(self, limit=None, mirror=None):
         self.uri_html_annotations = defaultdict(list)
         self.uri_updates = {}
         self.uris_by_recent_update = []
         self.uri_references = {}
         self.limit = limit
-        self.conversations = {}
+        self.conversations = defaultdict(list)  # parent id -> sorted (updated, id, reply)
+        self.fetched = set()  # ids of every row added
         self.by_url = 'no'
+        self.mirror = mirror  # an AnnotationMirror to read instead of the API
 
     def add_row(self, row, selected_user=None, selected_tags=None):
         """Add one API result to this instance."""
         raw = HypothesisRawAnnotation(row)
+        user_activity.add(raw)
+        self.fetched.add(raw.id)
         if len(raw.references):
-            ref = raw.references[0]
-            self.conversations[ref] = HypothesisHtmlAnnotation(self, raw, selected_tags, selected_user)
+            # Replies hang off their direct parent, oldest first
+            parent = raw.references[-1]
+            html_annotation = HypothesisHtmlAnnotation(self, raw, selected_tags, selected_user)
+            bisect.insort(self.conversations[parent], (raw.updated, raw.id, html_annotation))
             return
 
         uri = raw.uri
@@ -180,6 +385,16 @@ class HypothesisStream:
         html_annotation = HypothesisHtmlAnnotation(self, raw, selected_tags, selected_user)
         self.uri_html_annotations[uri].append( html_annotation )
 
+    def thread_replies(self):
+        """Move replies whose direct parent was not fetched under their nearest fetched ancestor."""
+        for parent in [parent for parent in self.conversations if parent not in self.fetched]:
+            for entry in self.conversations.pop(parent):
+                references = entry[2].raw.references
+                for ancestor in reversed(references[:-1]):
+                    if ancestor in self.fetched:
+                        bisect.insort(self.conversations[ancestor], entry)
+                        break
+
     def sort(self):
         """Order URIs by most recent update."""
         sorted_uri_updates = sorted(self.uri_updates.items(), key=operator.itemgetter(1), reverse=True)
@@ -223,7 +438,11 @@ class HypothesisStream:
         return quote
 
     def make_text_html(self, raw):
-        """Render an annotation's text."""
+        """Render an annotation's text, once per annotation version."""
+        key = ('text', raw.id, raw.updated)
+        return html_cache.get(key, lambda: self.render_text_html(raw))
+
+    def render_text_html(self, raw):
         text = raw.text
         if raw.is_page_note:
             text = '<span title="Page Note" class="h-icon-insert-comment"></span> ' + text
@@ -232,7 +451,11 @@ class HypothesisStream:
 
 
     def make_tag_html(self, raw, selected_user=None, selected_tags=None):
-        """Render an annotation's tags."""
+        """Render an annotation's tags, once per annotation version and filter."""
+        key = ('tags', raw.id, raw.updated, self.by_url, selected_user, selected_tags)
+        return html_cache.get(key, lambda: self.render_tag_html(raw, selected_user, selected_tags))
+
+    def render_tag_html(self, raw, selected_user=None, selected_tags=None):
         row_tags = raw.tags
         if len(row_tags) == 0:
             return ''
@@ -267,11 +490,11 @@ class HypothesisStream:
         return user, picklist, userlist
 
     @staticmethod
-    def alt_stream(request):
+    def alt_stream(request, mirror=None):
         """Entry point called from views.py (in H dev env) or h.py in this project."""
         limit = 200
         q = urlparse.parse_qs(request.query_string)
-        h_stream = HypothesisStream(limit)
+        h_stream = HypothesisStream(limit, mirror=mirror)
         if q.has_key('tags'):
             tags = q['tags'][0].split(',')
             tags = [t.strip() for t in tags]
@@ -290,13 +513,14 @@ class HypothesisStream:
         if h_stream.by_url=='yes':
             head = '<p class="stream-selector"><a href="/stream.alt?by_url=no">view recently active users</a></p>' 
             head += '<h1>urls recently annotated</h1>'
-            body = h_stream.make_alt_stream(user=None, tags=tags)
+            body = h_stream.iter_alt_stream(user=None, tags=tags)
         else:
             head = '<p class="stream-selector"><a href="/stream.alt?by_url=yes">view recently annotated urls</a></p>' 
             head += '<h1 class="stream-active-users-widget">urls recently annotated by {user} <span class="stream-picklist">{users}</span></h1>'.format(user=user, users=picklist)
-            body = h_stream.make_alt_stream(user=user, tags=tags)
-        html = HypothesisStream.alt_stream_template( {'head':head,  'main':body} )
-        return Response(html.encode('utf-8'))
+            body = h_stream.iter_alt_stream(user=user, tags=tags)
+        # Sent chunked, the head goes out before the search is done
+        chunks = HypothesisStream.iter_alt_stream_page(head, body)
+        return Response(chunk.encode('utf-8') for chunk in chunks)
 
     def display_url(self, html_annotation, uri):
         """Render an annotation's URI."""
@@ -317,47 +541,77 @@ class HypothesisStream:
 
     def display_html_annotation(self, html_annotation=None, first=None, uri=None, is_reply=None):
             """Assemble rendered parts of an annotation into one HTML element."""
-            s = ''
+            return ''.join(self.iter_html_annotation(html_annotation, first=first, uri=uri, is_reply=is_reply))
+
+    def iter_html_annotation(self, html_annotation=None, first=None, uri=None, is_reply=None):
+            """Yield the rendered parts of an annotation and its whole reply thread."""
             if first:
-                s = self.display_url(html_annotation, uri)
-        
-            if is_reply:
-                s += '<div class="stream-reply">'
-            else:
-                s += '<div class="paper stream-annotation">'
-
-            #s += '<p>' + html_annotation.raw.id + '</p>'
-        
-            if self.by_url == 'yes':
-                user = html_annotation.raw.user
-                s += '<p class="stream-user"><a href="/stream.alt?user=%s&by_url=no">%s</a></p>' % (user, user)
-            
-            quote_html = html_annotation.quote_html
-            text_html = html_annotation.text_html
-            tag_html = html_annotation.tag_html
-        
-            is_page_note = html_annotation.raw.is_page_note
-        
-            if quote_html != '':
-                s += """<p class="annotation-quote">%s</p>"""  % quote_html
-        
-            if text_html != '':
-                s += """<p class="stream-text">%s</p>""" %  (text_html)
-        
-            if tag_html != '':
-                s += '<p class="stream-tags">%s</p>' % tag_html
-        
-            annotation_id = html_annotation.raw.id
-            if self.conversations.has_key(annotation_id):
-                anno = self.conversations[annotation_id]
-                s += self.display_html_annotation(anno, first=False, uri=uri, is_reply=True)
-
-            s += '</div>'
-
-            return s
+                yield self.display_url(html_annotation, uri)
+
+            # Depth first without recursion, None closes the enclosing element
+            stack = [(html_annotation, is_reply)]
+            while stack:
+                item = stack.pop()
+                if item is None:
+                    yield '</div>'
+                    continue
+                html_annotation, is_reply = item
+
+                if is_reply:
+                    yield '<div class="stream-reply">'
+                else:
+                    yield '<div class="paper stream-annotation">'
+
+                if self.by_url == 'yes':
+                    user = html_annotation.raw.user
+                    yield '<p class="stream-user"><a href="/stream.alt?user=%s&by_url=no">%s</a></p>' % (user, user)
+
+                quote_html = html_annotation.quote_html
+                text_html = html_annotation.text_html
+                tag_html = html_annotation.tag_html
+
+                if quote_html != '':
+                    yield """<p class="annotation-quote">%s</p>"""  % quote_html
+
+                if text_html != '':
+                    yield """<p class="stream-text">%s</p>""" %  (text_html)
+
+                if tag_html != '':
+                    yield '<p class="stream-tags">%s</p>' % tag_html
+
+                stack.append(None)
+                replies = self.conversations.get(html_annotation.raw.id, ())
+                for updated, annotation_id, reply in reversed(replies):
+                    stack.append((reply, True))
 
     def make_alt_stream(self, user=None, tags=None):
         """Do requested API search, organize results."""
+        return ''.join(self.iter_alt_stream(user=user, tags=tags))
+
+    def iter_alt_stream(self, user=None, tags=None):
+        """Do requested API search, yield the HTML of one URI group at a time."""
+        if self.mirror is not None:
+            rows = self.mirror.rows(user=user, tags=tags, limit=self.limit)
+        else:
+            rows = self.search_rows(user=user, tags=tags)
+
+        with timing.span('stream_rows'):
+            for row in rows:
+               self.add_row(row, selected_user=user, selected_tags=tags)
+            self.thread_replies()
+            self.sort()
+
+        for uri in self.uris_by_recent_update:
+            html_annotations = self.uri_html_annotations[uri]
+            chunks = []
+            with timing.span('stream_render'):
+                for i in range(len(html_annotations)):
+                    first = ( i == 0 )
+                    chunks.extend(self.iter_html_annotation(html_annotations[i], first=first, uri=uri, is_reply=False))
+            yield ''.join(chunks)
+
+    def search_rows(self, user=None, tags=None):
+        """Rows of the requested API search."""
         bare_search_url = '%s/search?limit=%s' % ( HypothesisUtils().api_url, self.limit )
         parameterized_search_url = bare_search_url
 
@@ -368,28 +622,25 @@ class HypothesisStream:
             for tag in tags:
                 parameterized_search_url += '&tags=' + tag
 
-        response = requests.get(parameterized_search_url)
-
-        rows = response.json()['rows']
+        response = upstream.get(parameterized_search_url, stream=True)
 
-        for row in rows:
-           self.add_row(row, selected_user=user, selected_tags=tags)
-        self.sort()
-
-        s = ''
-        for uri in self.uris_by_recent_update:
-            html_annotations = self.uri_html_annotations[uri]
+        meta, rows = upstream.stream_json(response, 'rows')
+        return rows
 
-            for i in range(len(html_annotations)):
-                first = ( i == 0 )
-                html_annotation = html_annotations[i]
-                s += self.display_html_annotation(html_annotation,  first=first, uri=uri, is_reply=False)
-        return s
+    def seed_user_activity(self):
+        """Count the latest annotations, when no stream was fetched yet."""
+        if self.mirror is not None:
+            rows = self.mirror.rows(limit=self.limit)
+        else:
+            rows = self.search_rows()
+        user_activity.add_rows(rows)
 
     def make_active_users_selectable(self, user=None):
         """Enumerate active users, enable selection of one."""
-        active_users = HypothesisUtils().get_active_users()
-        most_active_user = active_users[0][0]
+        if user_activity.empty():
+            self.seed_user_activity()
+        active_users = user_activity.ranking()
+        most_active_user = active_users[0][0] if active_users else None
         select = ''
         for active_user in active_users:
             if user is not None and active_user[0] == user:
@@ -404,6 +655,16 @@ class HypothesisStream:
     </select>""" % (self.by_url, select)
         return most_active_user, select, active_users
 
+    @staticmethod
+    def iter_alt_stream_page(head, body):
+        """Yield the stream page around the chunks of body."""
+        marker = u'\x00main\x00'
+        before, after = HypothesisStream.alt_stream_template({'head':head, 'main':marker}).split(marker)
+        yield before
+        for chunk in body:
+            yield chunk
+        yield after
+
     @staticmethod
     def alt_stream_template(args):
         """Temporarily here to consolidate assets in this file."""
@@ -440,63 +701,153 @@ class HypothesisStream:
 </body>
 </html> """.format(head=args['head'],main=args['main'])
 
-class HypothesisRawAnnotation:
-    
+def parse_user(row):
+    return row['user'].replace('acct:','').replace('@hypothes.is','')
+
+def parse_uri(row):
+    uri = row['uri'].replace('https://via.hypothes.is/h/','').replace('https://via.hypothes.is/','')
+    if row['uri'].startswith('urn:x-pdf') and row.has_key('document'):
+        if row['document'].has_key('link'):
+            for link in row['document']['link']:
+                uri = link['href']
+                if uri.encode('utf-8').startswith('urn:') == False:
+                    break
+        if uri.encode('utf-8').startswith('urn:') and row['document'].has_key('filename'):
+            uri = row['document']['filename']
+    return uri
+
+def parse_tags(row):
+    tags = []
+    if row.has_key('tags') and row['tags'] is not None:
+        tags = row['tags']
+        if isinstance(tags, types.ListType):
+            tags = [t.strip() for t in tags]
+    return tags
+
+
+class HypothesisRawAnnotation(object):
+    """Encapsulate one row of a Hypothesis API search.
+
+    The common fields are parsed up front, the document title, links and
+    target selectors only when first used.
+    """
+
+    __slots__ = ('row', 'id', 'updated', 'user', 'uri', 'tags', 'text', 'references',
+                 '_doc_title', '_links', '_selectors')
+
     def __init__(self, row):
-        """Encapsulate one row of a Hypothesis API search."""
+        self.row = row
         self.id = row['id']
         self.updated = row['updated'][0:19]
-        self.user = row['user'].replace('acct:','').replace('@hypothes.is','')
-        self.uri = row['uri'].replace('https://via.hypothes.is/h/','').replace('https://via.hypothes.is/','')
-
-        if row['uri'].startswith('urn:x-pdf') and row.has_key('document'):
-            if row['document'].has_key('link'):
-                self.links = row['document']['link']
-                for link in self.links:
-                    self.uri = link['href']
-                    if self.uri.encode('utf-8').startswith('urn:') == False:
-                        break
-            if self.uri.encode('utf-8').startswith('urn:') and row['document'].has_key('filename'):
-                self.uri = row['document']['filename']
+        self.user = parse_user(row)
+        self.uri = parse_uri(row)
+        self.tags = parse_tags(row)
+        self.text = row.get('text', '')
+        self.references = row.get('references', [])
+        self._doc_title = self._links = self._selectors = None
 
-        if row.has_key('document') and row['document'].has_key('title'):
-            t = row['document']['title']
-            if isinstance(t, types.ListType) and len(t):
-                self.doc_title = t[0]
+    @staticmethod
+    def records(rows, keep_rows=False):
+        """Parse rows into one column-oriented record set, as they are read."""
+        return HypothesisRecordSet(rows, keep_rows)
+
+    @property
+    def target(self):
+        return self.row.get('target', [])
+
+    @property
+    def is_page_note(self):
+        return self.references == [] and self.target == [] and self.tags == []
+
+    @property
+    def doc_title(self):
+        if self._doc_title is None:
+            row = self.row
+            if row.has_key('document') and row['document'].has_key('title'):
+                t = row['document']['title']
+                if isinstance(t, types.ListType) and len(t):
+                    doc_title = t[0]
+                else:
+                    doc_title = t
             else:
-                self.doc_title = t
-        else:
-            self.doc_title = self.uri
-        self.doc_title = self.doc_title.replace('"',"'")
-        if self.doc_title == '': self.doc_title = 'untitled'
-
-        self.tags = []
-        if row.has_key('tags') and row['tags'] is not None:
-            self.tags = row['tags']
-            if isinstance(self.tags, types.ListType):
-                self.tags = [t.strip() for t in self.tags]
-
-        self.text = ''
-        if row.has_key('text'):
-            self.text = row['text']
-
-        self.references = []
-        if row.has_key('references'):
-            self.references = row['references']
-
-        self.target = []
-        if row.has_key('target'):
-            self.target = row['target']
-
-        self.is_page_note = False
-        if self.references == [] and self.target == [] and self.tags == []: 
-            self.is_page_note = True
-        if row.has_key('document') and row['document'].has_key('link'):
-            self.links = row['document']['link']
-            if not isinstance(self.links, types.ListType):
-                self.links = [{'href':self.links}]
-        else:
-            self.links = []
+                doc_title = self.uri
+            if doc_title is None:
+                doc_title = ''
+            doc_title = doc_title.replace('"',"'")
+            if doc_title == '': doc_title = 'untitled'
+            self._doc_title = doc_title
+        return self._doc_title
+
+    @property
+    def links(self):
+        if self._links is None:
+            row = self.row
+            if row.has_key('document') and row['document'].has_key('link'):
+                links = row['document']['link']
+                if not isinstance(links, types.ListType):
+                    links = [{'href':links}]
+            else:
+                links = []
+            self._links = links
+        return self._links
+
+    def parse_selectors(self):
+        """(start, end, prefix, exact, suffix) of the first target."""
+        if self._selectors is None:
+            start = end = prefix = exact = suffix = None
+            try:
+                target = self.target
+                if target is not None and len(target) and target[0].has_key('selector'):
+                    start = end = -1
+                    for selector in target[0]['selector']:
+                        if selector.get('type') == 'TextQuoteSelector':
+                            prefix = selector.get('prefix')
+                            exact = selector.get('exact')
+                            suffix = selector.get('suffix')
+                        elif selector.get('type') == 'TextPositionSelector' and selector.has_key('start'):
+                            start = selector['start']
+                            end = selector.get('end', -1)
+            except:
+                print(traceback.format_exc())
+            self._selectors = (start, end, prefix, exact, suffix)
+        return self._selectors
+
+    start = property(lambda self: self.parse_selectors()[0])
+    end = property(lambda self: self.parse_selectors()[1])
+    prefix = property(lambda self: self.parse_selectors()[2])
+    exact = property(lambda self: self.parse_selectors()[3])
+    suffix = property(lambda self: self.parse_selectors()[4])
+
+
+class HypothesisRecordSet(object):
+    """Column-oriented common fields of a page of search rows."""
+
+    __slots__ = ('rows', 'id', 'updated', 'user', 'uri', 'tags', 'text', 'references')
+
+    def __init__(self, rows, keep_rows=False):
+        """Each row is dropped once its fields are read, unless keep_rows."""
+        self.rows = [] if keep_rows else None
+        self.id, self.updated, self.user, self.uri = [], [], [], []
+        self.tags, self.text, self.references = [], [], []
+        for row in rows:
+            self.id.append(row['id'])
+            self.updated.append(row['updated'][0:19])
+            self.user.append(parse_user(row))
+            self.uri.append(parse_uri(row))
+            self.tags.append(parse_tags(row))
+            self.text.append(row.get('text', ''))
+            self.references.append(row.get('references', []))
+            if keep_rows:
+                self.rows.append(row)
+
+    def __len__(self):
+        return len(self.id)
+
+    def __getitem__(self, i):
+        """Full annotation for one record, only when the rows were kept."""
+        if self.rows is None:
+            raise TypeError('records were built without keep_rows')
+        return HypothesisRawAnnotation(self.rows[i])
 
 
 class HypothesisHtmlAnnotation:
@@ -1,84 +1,2 @@
-import requests, re, json
+# HypothesisRawAnnotation is shared with the stream renderer in h_util
 from h_util import *
-
-class HypothesisRawAnnotation:
-    
-    def __init__(self, row):
-        """Encapsulate one row of a Hypothesis API search."""
-        self.id = row['id']
-        self.updated = row['updated'][0:19]
-        self.user = row['user'].replace('acct:','').replace('@hypothes.is','')
-        self.uri = row['uri'].replace('https://via.hypothes.is/h/','').replace('https://via.hypothes.is/','')
-
-        if row['uri'].startswith('urn:x-pdf') and row.has_key('document'):
-            if row['document'].has_key('link'):
-                self.links = row['document']['link']
-                for link in self.links:
-                    self.uri = link['href']
-                    if self.uri.encode('utf-8').startswith('urn:') == False:
-                        break
-            if self.uri.encode('utf-8').startswith('urn:') and row['document'].has_key('filename'):
-                self.uri = row['document']['filename']
-
-        if row.has_key('document') and row['document'].has_key('title'):
-            t = row['document']['title']
-            if isinstance(t, types.ListType) and len(t):
-                self.doc_title = t[0]
-            else:
-                self.doc_title = t
-        else:
-            self.doc_title = self.uri
-        if self.doc_title is None:
-            self.doc_title = ''
-        self.doc_title = self.doc_title.replace('"',"'")
-        if self.doc_title == '': self.doc_title = 'untitled'
-
-        self.tags = []
-        if row.has_key('tags') and row['tags'] is not None:
-            self.tags = row['tags']
-            if isinstance(self.tags, types.ListType):
-                self.tags = [t.strip() for t in self.tags]
-
-        self.text = ''
-        if row.has_key('text'):
-            self.text = row['text']
-
-        self.references = []
-        if row.has_key('references'):
-            self.references = row['references']
-
-        self.target = []
-        if row.has_key('target'):
-            self.target = row['target']
-
-        self.is_page_note = False
-        if self.references == [] and self.target == []: 
-            self.is_page_note = True
-        if row.has_key('document') and row['document'].has_key('link'):
-            self.links = row['document']['link']
-            if not isinstance(self.links, types.ListType):
-                self.links = [{'href':self.links}]
-        else:
-            self.links = []
-
-        self.start = self.end = self.prefix = self.exact = self.suffix = None
-
-        try:
-            if self.target is not None and len(self.target) and self.target[0].has_key('selector'):
-                selectors = self.target[0]['selector']
-                for selector in selectors:
-                    if selector.has_key('type') and selector['type'] == 'TextQuoteSelector':
-                        try:
-                            self.prefix = selector['prefix']
-                            self.exact = selector['exact']
-                            self.suffix = selector['suffix']
-                        except:
-                            pass
-                    if selector.has_key('type') and selector['type'] == 'TextPositionSelector' and selector.has_key('start'):
-                        self.start = selector['start']
-                        self.end = selector['end']
-                    else:
-                        self.start = -1
-                        self.end = -1
-        except:
-            print traceback.format_exc()
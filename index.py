@@ -1,56 +1,129 @@
-from flask import Flask, render_template
-from hypothesis import HypothesisRawAnnotation
-import requests
+from flask import Flask, render_template, make_response, request, jsonify, abort, g
+from hypothesis import HypothesisRawAnnotation, HypothesisStream, html_cache
+from catalog import CollectionCatalog
+from h_search import HypothesisSearch
+from resolver import RedirectResolver
+from mirror import AnnotationMirror
+from warmup import WarmupScheduler
+from functools import partial
+from cache import TTLCache
+import settings
+import upstream
+import timing
+from io import BytesIO
+import hashlib
+import time
+import gzip
+import zlib
+import os
 import numpy
 import json
 import re
-import pandas
 
 app = Flask(__name__)
 
+# Memory-mapped once per process, reloaded when the snapshot changes
+catalog = CollectionCatalog()
+
+# Precomputed metadata completeness of every collection (see completeness.py)
+completeness = CollectionCatalog(settings.COMPLETENESS_SNAPSHOT,pickle=None)
+
+# Collection page URL -> canonical URL that is annotated
+resolver = RedirectResolver()
+
+# Synced annotation copy, read instead of hypothes.is when configured
+mirror = None
+if settings.ANNOTATION_SOURCE == "mirror":
+    mirror = AnnotationMirror()
+
+# The index page only shows these columns
+INDEX_COLUMNS = ["collection_id","name"]
+
+# Parsed Hypothesis search results, keyed by search URL
+annotation_cache = TTLCache(maxsize=settings.ANNOTATION_CACHE_SIZE,
+                            ttl=settings.ANNOTATION_CACHE_TTL,
+                            stale=settings.ANNOTATION_CACHE_STALE)
+
+# Important fields of every image, keyed by collection id
+image_cache = TTLCache(maxsize=settings.IMAGE_CACHE_SIZE,
+                       ttl=settings.IMAGE_CACHE_TTL,
+                       stale=settings.IMAGE_CACHE_STALE)
+
 def get_annotations(urls,column_names):
     if not isinstance(urls,list): urls = [urls]
     annotations = dict()
-    for u in urls:
-        url = requests.get(u).url
-        url = "https://hypothes.is/api/search?uri=%s" %(url)
-        text = requests.get(url).text.decode('utf-8')
-        rows = json.loads(text)['rows']
-        raw = [HypothesisRawAnnotation(row) for row in rows]        
-        annots = []        
-        for r in raw:
-            data = dict()
-            # Find tags, and ids
-            ids = [id for id in [re.findall("^-?[0-9]+$",tag) for tag in r.tags] if id]
-            if ids:
-                ids = ids[0]
-            else:
-                ids = []
-            tags = [tag for tag in r.tags if tag not in ids]
-            if len(ids)==0: ids = None
-            # We are only taking the first id annotation, one image per annotation
-            data["image_id"] = ids
-            data["tags"] = [{tag:r.text} for tag in tags]
-            annots.append(data)
+    results = upstream.fan_out([partial(get_url_annotations,u) for u in urls],
+                               defaults=[[] for u in urls])
+    for u,annots in zip(urls,results):
         if len(annots) > 0:
             annotations[u] = annots
     return annotations    
 
-def get_images(pk):
-    url = "http://neurovault.org/api/collections/%s/images/?format=json" %pk    
-    return json.loads(requests.get(url).text.decode('utf-8'))
-
-def get_collections(pk=None):
-    # Retrieve neurovault images, sort
-    pkl = "static/data/nv_collections.pkl"
-    collections = pandas.read_pickle(pkl)
-    collections = collections[collections["DOI"].isnull()==False]
-    
-    # Remove more proprietary stuffs
-    collections =  collections.drop(["owner","add_date","contributors"],axis=1)
-    if pk:
-        collections = collections[collections.collection_id==int(pk)]
-    return collections
+# Annotations for one collection page
+def get_url_annotations(u):
+    with timing.span("resolve"):
+        uri = resolver.resolve(u)
+    with timing.span("search"):
+        return annotation_cache.get(search_key(uri),partial(search_annotations,uri))
+
+def search_key(uri):
+    return "%s/api/search?uri=%s" %(settings.HYPOTHESIS_URL,uri)
+
+# Search hypothes.is (every page) or the local mirror, keeping image ids and tags of each annotation
+def search_annotations(uri):
+    if mirror is not None:
+        rows = mirror.rows(uri=uri,order="asc")
+    else:
+        rows = HypothesisSearch({"uri":uri}).rows()
+    records = HypothesisRawAnnotation.records(rows)
+    annots = []        
+    for annotation_id,updated,row_tags,text in zip(records.id,records.updated,records.tags,records.text):
+        data = dict()
+        # Find tags, and ids
+        ids = [id for id in [re.findall("^-?[0-9]+$",tag) for tag in row_tags] if id]
+        if ids:
+            ids = ids[0]
+        else:
+            ids = []
+        tags = [tag for tag in row_tags if tag not in ids]
+        if len(ids)==0: ids = None
+        # We are only taking the first id annotation, one image per annotation
+        data["image_id"] = ids
+        data["tags"] = [{tag:text} for tag in tags]
+        data["id"] = annotation_id
+        data["updated"] = updated
+        annots.append(data)
+    return annots
+
+# All images of a collection, in API order, streamed page by page
+def get_images(pk,page_size=settings.IMAGES_PAGE_SIZE,workers=settings.IMAGES_WORKERS):
+    meta,first = stream_images_page(pk,0,page_size)
+    step = 0
+    for image in first:
+        step += 1
+        yield image
+
+    # The server may cap the page size, step by what it actually returned
+    if step == 0 or meta.get("next") is None:
+        return
+    offsets = range(step,meta["count"],step)
+    pages = upstream.imap(partial(get_images_page,pk,limit=step),offsets,workers=workers)
+    for page in pages:
+        for image in page:
+            yield image
+
+def stream_images_page(pk,offset,limit):
+    url = "%s/api/collections/%s/images/?format=json&limit=%s&offset=%s" %(settings.NEUROVAULT_URL,pk,limit,offset)
+    return upstream.stream_json(upstream.get(url,stream=True),"results")
+
+def get_images_page(pk,offset,limit):
+    meta,images = stream_images_page(pk,offset,limit)
+    return list(images)
+
+def get_collections(pk=None,columns=None):
+    # Published collections, or the single row for pk
+    with timing.span("catalog"):
+        return catalog.get(pk,columns=columns)
 
 # Change nan values to None to render correctly in interface
 def nan_to_none(field):
@@ -61,24 +134,36 @@ def nan_to_none(field):
         pass
     return field
 
-# Important fields
+# Important fields of one image
+def get_image_fields(image):
+    smoothness = nan_to_none(image["smoothness_fwhm"])
+    return {"figure":image["figure"],
+            "cognitive_paradigm_cogatlas":image["cognitive_paradigm_cogatlas"],
+            "contrast_definition":image["contrast_definition"],
+            "image_type":image["image_type"],
+            "modality":image["modality"],
+            "name":image["name"],
+            "map_type":image["map_type"],
+            "smoothness_fwhm":smoothness,
+            "thumbnail":image["thumbnail"],
+            "url":image["url"],
+            "id":image["id"]}
+
+# Important fields of every image in a collection, kept from the API stream
+def get_collection_images(pk):
+    with timing.span("images"):
+        return image_cache.get(int(pk),partial(fetch_collection_images,pk))
+
+def fetch_collection_images(pk):
+    return [get_image_fields(image) for image in get_images(pk)]
+
+# Important fields (images are copied, annotations are merged into them)
 def get_important_fields(images,coll):
     metadata = []
     missing = 0
     present = 0
-    for image in images["results"]:
-        smoothness = nan_to_none(image["smoothness_fwhm"])
-        image_metadata = {"figure":image["figure"],
-                         "cognitive_paradigm_cogatlas":image["cognitive_paradigm_cogatlas"],
-                         "contrast_definition":image["contrast_definition"],
-                         "image_type":image["image_type"],
-                         "modality":image["modality"],
-                         "name":image["name"],
-                         "map_type":image["map_type"],
-                         "smoothness_fwhm":smoothness,
-                         "thumbnail":image["thumbnail"],
-                         "url":image["url"],
-                         "id":image["id"]}
+    for image in images:
+        image_metadata = dict(image)
         missing += sum(x is None for x in image_metadata.values())
         present += sum(x is not None for x in image_metadata.values())
         metadata.append(image_metadata)
@@ -96,7 +181,7 @@ def get_important_fields(images,coll):
             "id":coll["collection_id"].values[0]}
 
     missing = (sum(x is None for x in collection.values())) + missing
-    present = (sum(x is None for x in collection.values())) + present
+    present = (sum(x is not None for x in collection.values())) + present
     collection["missing"] = missing
     collection["present"] = present
     return {"images":metadata,"collection":collection}
@@ -105,43 +190,81 @@ def get_important_fields(images,coll):
 # Defined fields will not be over-written by annotations
 # We can only match images to annotations based on imageID tags
 def update_fields(annotations,fields):
-    annots = annotations.values()[0]
+    fields,stats = merge_annotations(annotations,fields)
+    return fields
+
+# Apply all annotations in one pass over an id -> image index. The newest
+# annotation (then highest id) wins a field, whatever order the API used,
+# so a curator's correction replaces the earlier tag.
+def merge_annotations(annotations,fields):
+    images = dict((image["id"],image) for image in fields["images"])
+    annots = [annot for url in annotations for annot in annotations[url]]
+    annots.sort(key=lambda annot: (annot.get("updated",""),annot.get("id","")),reverse=True)
+    stats = {"annotations":len(annots),"applied":0,"conflicts":0,"unmatched":[]}
     for annot in annots:
         # An image annotation
         if annot["image_id"] != None:
-             idx = [x for x in range(0,len(fields["images"])) if fields["images"][x]["id"] == int(annot["image_id"][0])][0]
-             fields["images"][idx] = update_field(annot,fields["images"][idx])
-        
+            image = images.get(int(annot["image_id"][0]))
+            if image is None:
+                stats["unmatched"].append(annot)
+            else:
+                update_field(annot,image,stats)
+
         # A collection annotation
         else:
-            fields["collection"] = update_field(annot,fields["collection"])
-    return fields
+            update_field(annot,fields["collection"],stats)
+    return fields,stats
 
 # Update a single field
-def update_field(annot,fields):
+def update_field(annot,fields,stats=None):
+    if stats is None:
+        stats = {"applied":0,"conflicts":0}
     for group in annot["tags"]:
         for tag,val in group.iteritems():
             try:
                 if not fields[tag]:
                     fields[tag] = val
+                    stats["applied"] += 1
+                elif not same_value(fields[tag],val):
+                    stats["conflicts"] += 1
             except:
                 pass
     return fields
 
+# Compare a field (often a numpy scalar or byte string from the catalog) with
+# the unicode value of a tag, numbers by value so 20.0 and "20" agree
+def same_value(current,val):
+    current = to_json(current)
+    if isinstance(current,(int,long,float)) and not isinstance(current,bool):
+        try:
+            return float(current) == float(val)
+        except (TypeError,ValueError):
+            return False
+    return field_text(current) == field_text(val)
+
+def field_text(value):
+    if isinstance(value,str):
+        return value.decode('utf-8','replace')
+    return unicode(value)
+
 # 
 def update_annotations(url,collection,pk):
-    annots = get_annotations(url,collection.columns)
-    # Get images using the neurovault API
-    images = get_images(pk)
+    # Get annotations, and images using the neurovault API, concurrently
+    annots,images = upstream.fan_out([timing.bind(partial(get_annotations,url,collection.columns)),
+                                      timing.bind(partial(get_collection_images,pk))],
+                                     defaults=[dict(),[]])
     # Get important image and collection fields
-    fields = get_important_fields(images,collection)
+    with timing.span("fields"):
+        fields = get_important_fields(images,collection)
 
     # Match annotations to fields
     if len(annots) == 0:
         annots[url] = [{"image_id":None,
                        "tags":[{"No annotations found!":""}]}] 
     else:
-        fields = update_fields(annots,fields)
+        with timing.span("merge"):
+            fields,stats = merge_annotations(annots,fields)
+        fields["merge"] = stats
     return annots,images,fields
 
 # Single collection view
@@ -150,22 +273,209 @@ def collection(pk):
     collection = get_collections(pk=pk)
     # Get annotations for the pk
     url = collection["url"].tolist()[0]
+    # Queued for warm-up only once the collection is known to exist
+    warmup.viewed(pk)
     annots,images,fields = update_annotations(url,collection,pk)
-    return render_template("collection.html",
-                           images=images,
-                           annotations=annots,
-                           fields=fields)
+    with timing.span("render"):
+        return render_template("collection.html",
+                               images=images,
+                               annotations=annots,
+                               fields=fields)
 
 # Show annotations for a collection
 @app.route("/annotate/<pk>")
 def annotate(pk):
-    collections = get_collections()
     collection = get_collections(pk)
     # Get annotations for the pk
     url = collection["url"].tolist()[0]
-    annots = get_annotations(url,collection.columns)
+    # Queued for warm-up only once the collection is known to exist
+    warmup.viewed(pk)
     annots,images,fields = update_annotations(url,collection,pk)
-    return main_page(collections,annotations=annots,fields=fields)
+    return main_page(annotations=annots,fields=fields)
+
+# Reload the annotation and image caches of one collection
+def warm_collection(pk):
+    collection = get_collections(pk)
+    uri = resolver.resolve(collection["url"].tolist()[0])
+    annotation_cache.set(search_key(uri),search_annotations(uri))
+    image_cache.set(int(pk),fetch_collection_images(pk))
+
+warmup = WarmupScheduler(warm_collection,
+                         lambda: get_collections(columns=["collection_id"])["collection_id"].tolist())
+
+# Resolve every collection page URL ahead of its first view, and keep
+# collection caches warm in the background
+@app.before_first_request
+def start_background():
+    resolver.preload(list(get_collections(columns=["url"])["url"]))
+    if settings.WARMUP_ENABLED:
+        warmup.start()
+
+# JSON API for machine clients: the catalog, merged fields and annotations of
+# one collection. Bodies are compact, gzip or deflate compressed when the
+# client accepts it, and validated by ETags so unchanged data costs a 304.
+@app.route("/api/collections")
+def api_collections():
+    etag = hashlib.sha1(repr(catalog.version).encode('utf-8')).hexdigest()
+    return api_response(catalog_records,etag,cache=True)
+
+@app.route("/api/collections/<int:pk>")
+def api_collection(pk):
+    collection,url = api_collection_row(pk)
+    annots,images = api_fetch(url,pk)
+    def fields():
+        fields = get_important_fields(images,collection)
+        if len(annots) > 0:
+            fields,stats = merge_annotations({url:annots},fields)
+            fields["merge"] = stats
+        return fields
+    return api_response(fields,annotation_etag(pk,annots,images))
+
+@app.route("/api/collections/<int:pk>/annotations")
+def api_annotations(pk):
+    collection,url = api_collection_row(pk)
+    annots, = api_fetch(url,pk,images=False)
+    return api_response(lambda: {url:annots} if len(annots) > 0 else dict(),annotation_etag(pk,annots))
+
+def api_collection_row(pk):
+    collection = get_collections(pk=pk)
+    if len(collection) == 0:
+        abort(404)
+    return collection,collection["url"].tolist()[0]
+
+# Published collections, with typed values and null for missing ones
+def catalog_records():
+    collections = get_collections()
+    collections = collections.astype(object).where(collections.notnull(),None)
+    return collections.to_dict(orient="records")
+
+# Annotations (and images) of one collection for the API. Unlike the pages,
+# which render with whatever arrived, a failed upstream is a 503: partial
+# data would be served and validated by an ETag as if it were complete.
+def api_fetch(url,pk,images=True):
+    calls = [timing.bind(partial(get_url_annotations,url))]
+    if images:
+        calls.append(timing.bind(partial(get_collection_images,pk)))
+    results = upstream.fan_out(calls,defaults=[None] * len(calls))
+    if any(result is None for result in results):
+        abort(503)
+    return results
+
+# Changes with the catalog, whenever an annotation of the collection is
+# added, edited or deleted (newest updated time and count), and with the
+# images when they are part of the body
+def annotation_etag(pk,annots,images=None):
+    watermark = max([annot.get("updated") or "" for annot in annots] or [""])
+    version = repr((catalog.version,pk,len(annots),watermark))
+    if images is not None:
+        version += json.dumps(to_json(images),sort_keys=True)
+    return hashlib.sha1(version.encode('utf-8')).hexdigest()
+
+# Serialized (and compressed) catalog bodies, per ETag and encoding
+api_bodies = TTLCache(maxsize=16,ttl=float("inf"))
+
+def api_response(payload,etag=None,cache=False):
+    encoding = accepted_encoding()
+    if etag is not None and encoding is not None:
+        etag = "%s-%s" %(etag,encoding)
+    if etag is not None and request.if_none_match.contains(etag):
+        response = make_response("",304)
+    else:
+        load = partial(api_body,payload,encoding)
+        if cache and etag is not None:
+            body,encoding = api_bodies.get((etag,encoding),load)
+        else:
+            body,encoding = load()
+        response = make_response(body)
+        response.mimetype = "application/json"
+        if encoding is not None:
+            response.headers["Content-Encoding"] = encoding
+    if etag is not None:
+        response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    return response
+
+def api_body(payload,encoding=None):
+    body = json.dumps(to_json(payload()),separators=(",",":"))
+    if not isinstance(body,bytes):
+        body = body.encode('utf-8')
+    # Small bodies are not worth compressing
+    if encoding is None or len(body) < settings.API_COMPRESS_MIN_SIZE:
+        return body,None
+    if encoding == "gzip":
+        buf = BytesIO()
+        with gzip.GzipFile(fileobj=buf,mode="wb",compresslevel=settings.API_COMPRESS_LEVEL) as filey:
+            filey.write(body)
+        return buf.getvalue(),encoding
+    return zlib.compress(body,settings.API_COMPRESS_LEVEL),encoding
+
+def accepted_encoding():
+    for encoding in ("gzip","deflate"):
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+# numpy scalars to python values, nan to null
+def to_json(value):
+    if isinstance(value,dict):
+        return dict((key,to_json(val)) for key,val in value.items())
+    if isinstance(value,(list,tuple)):
+        return [to_json(val) for val in value]
+    if isinstance(value,numpy.generic):
+        value = value.item()
+    if isinstance(value,float) and numpy.isnan(value):
+        return None
+    return value
+
+# Time every request, stages measured on the way are sent as Server-Timing
+# (spans of streamed bodies happen later, they only reach /metrics)
+@app.before_request
+def start_timing():
+    g.started = time.time()
+    timing.start()
+
+@app.after_request
+def add_server_timing(response):
+    spans = timing.stop()
+    elapsed = time.time() - g.started
+    timing.request_seconds.observe((request.endpoint,response.status_code),elapsed)
+    if settings.SERVER_TIMING and spans is not None:
+        response.headers["Server-Timing"] = timing.server_timing(spans,elapsed)
+    return response
+
+# Stage, request and upstream histograms, upstream status codes and cache hit rates
+@app.route("/metrics")
+def metrics():
+    caches = [("annotations",annotation_cache),("images",image_cache),
+              ("stream_html",html_cache),("index_pages",index_pages),("api_bodies",api_bodies)]
+    stats = [(name,cache.stats()) for name,cache in caches]
+    body = timing.exposition(
+        timing.gauge("nva_cache_hit_rate","Fraction of cache lookups served from the cache",
+                     [([("cache",name)],stat["hit_rate"]) for name,stat in stats]),
+        timing.gauge("nva_cache_size","Entries in each cache",
+                     [([("cache",name)],stat["size"]) for name,stat in stats]),
+        timing.counter("nva_cache_lookups_total","Cache lookups since start, by result",
+                     [([("cache",name),("result",result)],stat[result])
+                      for name,stat in stats for result in ("hits","stale_hits","misses")]),
+        timing.counter("nva_upstream_requests_sent_total","Upstream requests sent, including retries",
+                     [([],upstream.client.sent)]))
+    response = make_response(body)
+    response.mimetype = "text/plain"
+    response.headers["Content-Type"] = "text/plain; version=0.0.4"
+    return response
+
+# Upstream cache counters and warm-up progress
+@app.route("/status")
+def status():
+    return jsonify(caches={"annotations":annotation_cache.stats(),
+                           "images":image_cache.stats(),
+                           "stream_html":html_cache.stats()},
+                   warmup=warmup.stats())
+
+# Recently annotated urls (or users), streamed as it is rendered
+@app.route("/stream.alt")
+def stream():
+    return HypothesisStream.alt_stream(request,mirror=mirror)
 
 @app.route("/faq")
 def faq():
@@ -174,10 +484,69 @@ def faq():
 
 @app.route("/")
 def annotate_nv():
-    collections = get_collections()
-    return main_page(collections)
- 
-def main_page(collections,annotations=None,fields=None):
+    sort,minimum = index_view(request.args)
+    page = get_index_page(sort,minimum)
+    response = make_response(page["body"])
+    response.set_etag(page["etag"])
+    # Clients sending a matching If-None-Match get a 304
+    return response.make_conditional(request)
+
+# ?sort=<completeness column> lists the most incomplete collections first,
+# ?min=N only lists collections with at least N of them
+def index_view(args):
+    sort = args.get("sort")
+    if sort not in completeness_columns():
+        return None,None
+    try:
+        minimum = int(args.get("min"))
+    except (TypeError,ValueError):
+        minimum = None
+    return sort,minimum
+
+# Completeness index columns that can be sorted on, none until completeness.py ran
+def completeness_columns():
+    if not os.path.exists(completeness.source()):
+        return []
+    return [name for name in completeness.refresh()[1].keys() if name != "collection_id"]
+
+# Collection list, rendered page and ETag, per catalog and completeness version and view
+index_pages = TTLCache(maxsize=64,ttl=float("inf"))
+
+def get_index_page(sort=None,minimum=None):
+    version = catalog.version
+    if os.path.exists(completeness.source()):
+        version = (version,completeness.version)
+    return index_pages.get((version,sort,minimum),partial(render_index_page,sort,minimum))
+
+def render_index_page(sort=None,minimum=None):
+    lists = collection_list(get_collections(columns=INDEX_COLUMNS))
+    lists = add_completeness(lists,sort,minimum)
+    with timing.span("render"):
+        body = render_template("index.html",collections=lists,sort=sort,minimum=minimum)
+    etag = hashlib.sha1(body.encode('utf-8')).hexdigest()
+    return {"collections":lists,"body":body,"etag":etag}
+
+# Missing and present field counts of each collection, from the precomputed index
+def add_completeness(lists,sort=None,minimum=None):
+    columns = completeness_columns()
+    if not columns:
+        return lists
+    names = ["collection_id","missing","present"]
+    if sort is not None and sort not in names:
+        names.append(sort)
+    scores = completeness.get(columns=names)
+    scores = dict((int(row[0]),dict(zip(names[1:],map(int,row[1:])))) for row in scores.values)
+    for collection in lists:
+        collection.update(scores.get(int(collection["collection_id"]),{}))
+    if sort is None:
+        return lists
+    lists = [collection for collection in lists if sort in collection]
+    if minimum is not None:
+        lists = [collection for collection in lists if collection[sort] >= minimum]
+    lists.sort(key=lambda collection: collection[sort],reverse=True)
+    return lists
+
+def collection_list(collections):
 
     # Convert (most) columns to strings
     for col in collections.columns:
@@ -186,18 +555,19 @@ def main_page(collections,annotations=None,fields=None):
         except:
             pass
 
-    # Fill in nan with None
-    collections[collections.isnull()] = None
+    # Fill in nan with None, and convert each collection into a dict
+    collections = collections.where(collections.notnull(),None)
+    return collections.to_dict(orient="records")
 
-    # Convert each collection into a dict
-    lists = []
-    for row in collections.iterrows():
-        lists.append(row[1].to_dict())
+def main_page(annotations=None,fields=None):
+    with timing.span("index"):
+        lists = get_index_page()["collections"]
 
     # render images with contrasts tagged
-    if annotations != None:
-        return render_template("index.html",collections=lists,annotations=annotations,fields=fields)
-    return render_template("index.html",collections=lists)
+    with timing.span("render"):
+        if annotations != None:
+            return render_template("index.html",collections=lists,annotations=annotations,fields=fields)
+        return render_template("index.html",collections=lists)
 
 if __name__ == "__main__":
     app.debug = True
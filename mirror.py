@@ -0,0 +1,188 @@
+from h_util import HypothesisUtils, parse_user, parse_tags
+import argparse
+import sqlite3
+import json
+import re
+import os
+import settings
+
+try:
+    from urlparse import urlsplit, parse_qsl
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlsplit, parse_qsl, urlencode
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS annotations (id TEXT PRIMARY KEY, uri TEXT, user TEXT, updated TEXT, row TEXT);
+CREATE TABLE IF NOT EXISTS annotation_tags (id TEXT, tag TEXT);
+CREATE TABLE IF NOT EXISTS annotation_images (id TEXT, image_id INTEGER);
+CREATE TABLE IF NOT EXISTS annotation_uris (id TEXT, uri TEXT);
+CREATE INDEX IF NOT EXISTS annotations_uri ON annotations (uri, updated);
+CREATE INDEX IF NOT EXISTS annotations_user ON annotations (user, updated);
+CREATE INDEX IF NOT EXISTS annotations_updated ON annotations (updated);
+CREATE INDEX IF NOT EXISTS annotation_tags_tag ON annotation_tags (tag, id);
+CREATE INDEX IF NOT EXISTS annotation_tags_id ON annotation_tags (id);
+CREATE INDEX IF NOT EXISTS annotation_images_image ON annotation_images (image_id, id);
+CREATE INDEX IF NOT EXISTS annotation_images_id ON annotation_images (id);
+CREATE INDEX IF NOT EXISTS annotation_uris_uri ON annotation_uris (uri, id);
+CREATE INDEX IF NOT EXISTS annotation_uris_id ON annotation_uris (id);
+"""
+
+
+def normalize_uri(uri):
+    """Key that equivalent URIs share, like the Hypothesis search compares them.
+
+    http and https, host case, default ports, a trailing slash, the
+    fragment, utm_* parameters and query order make no difference.
+    """
+    uri = uri.strip()
+    parts = urlsplit(uri)
+    scheme = parts.scheme.lower()
+    if scheme not in ("http","https"):
+        return uri
+    netloc = parts.netloc.lower()
+    for port in (":80",":443"):
+        if netloc.endswith(port):
+            netloc = netloc[:-len(port)]
+    path = parts.path.rstrip("/")
+    query = sorted((name,value) for name,value in parse_qsl(parts.query,keep_blank_values=True)
+                   if not name.startswith("utm_"))
+    uri = "httpx://%s%s" %(netloc,path)
+    if query:
+        uri += "?" + urlencode(query)
+    return uri
+
+def row_uris(row):
+    """Normalized URIs of the annotated document: its uri, links and target sources."""
+    uris = [row['uri']]
+    document = row.get('document') or {}
+    links = document.get('link') or []
+    if not isinstance(links,list):
+        links = [{'href':links}]
+    uris.extend(link.get('href') for link in links if isinstance(link,dict))
+    uris.extend(target.get('source') for target in row.get('target') or [] if isinstance(target,dict))
+    return sorted(set(normalize_uri(uri) for uri in uris if uri))
+
+
+class AnnotationMirror:
+
+    def __init__(self, path=settings.MIRROR_DB):
+        """Local SQLite copy of the Hypothesis annotations."""
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        db = self.connect()
+        try:
+            db.executescript(SCHEMA)
+            # Mirrors synced before URIs were indexed get them from the stored rows
+            if db.execute("SELECT 1 FROM annotation_uris LIMIT 1").fetchone() is None:
+                with db:
+                    for (row,) in db.execute("SELECT row FROM annotations").fetchall():
+                        self.index_uris(db,json.loads(row))
+        finally:
+            db.close()
+
+    def connect(self):
+        return sqlite3.connect(self.path,timeout=30)
+
+    def watermark(self):
+        """updated timestamp of the newest annotation in the mirror."""
+        db = self.connect()
+        try:
+            return db.execute("SELECT MAX(updated) FROM annotations").fetchone()[0]
+        finally:
+            db.close()
+
+    def index_uris(self, db, row):
+        db.execute("DELETE FROM annotation_uris WHERE id = ?",(row['id'],))
+        db.executemany("INSERT INTO annotation_uris VALUES (?, ?)",
+                       [(row['id'],uri) for uri in row_uris(row)])
+
+    def resume_point(self):
+        """Cursor to sync from: the newest updated before the watermark.
+
+        search_after is exclusive, so starting there fetches the watermark's
+        own timestamp again, which any annotation written later with that
+        same updated time needs. Stored rows are simply replaced.
+        """
+        db = self.connect()
+        try:
+            return db.execute("SELECT MAX(updated) FROM annotations WHERE updated < "
+                              "(SELECT MAX(updated) FROM annotations)").fetchone()[0]
+        finally:
+            db.close()
+
+    def store(self, rows):
+        """Insert or replace search rows, with their tags and image ids."""
+        db = self.connect()
+        try:
+            with db:
+                for row in rows:
+                    tags = parse_tags(row)
+                    images = [int(tag) for tag in tags if re.match("^-?[0-9]+$",tag)]
+                    db.execute("INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?, ?)",
+                               (row['id'],row['uri'],parse_user(row),row['updated'],json.dumps(row)))
+                    db.execute("DELETE FROM annotation_tags WHERE id = ?",(row['id'],))
+                    db.execute("DELETE FROM annotation_images WHERE id = ?",(row['id'],))
+                    db.executemany("INSERT INTO annotation_tags VALUES (?, ?)",
+                                   [(row['id'],tag) for tag in tags])
+                    db.executemany("INSERT INTO annotation_images VALUES (?, ?)",
+                                   [(row['id'],image) for image in images])
+                    self.index_uris(db,row)
+        finally:
+            db.close()
+
+    def sync(self, windows=1, batch=500):
+        """Pull the annotations updated since the watermark, returns how many were stored.
+
+        Annotations deleted on hypothes.is are not noticed by an incremental sync.
+        """
+        rows = HypothesisUtils().search_all(search_after=self.resume_point(),windows=windows)
+        count = 0
+        pending = []
+        for row in rows:
+            pending.append(row)
+            if len(pending) >= batch:
+                self.store(pending)
+                count += len(pending)
+                pending = []
+        self.store(pending)
+        return count + len(pending)
+
+    def rows(self, uri=None, user=None, tags=None, image_id=None, limit=None, order="desc"):
+        """Search rows in the mirror, filtered like the Hypothesis search API."""
+        sql = "SELECT row FROM annotations WHERE 1 = 1"
+        args = []
+        if uri is not None:
+            sql += " AND id IN (SELECT id FROM annotation_uris WHERE uri = ?)"
+            args.append(normalize_uri(uri))
+        if user is not None:
+            sql += " AND user = ?"
+            args.append(user.replace('acct:','').replace('@hypothes.is',''))
+        for tag in tags or ():
+            sql += " AND id IN (SELECT id FROM annotation_tags WHERE tag = ?)"
+            args.append(tag)
+        if image_id is not None:
+            sql += " AND id IN (SELECT id FROM annotation_images WHERE image_id = ?)"
+            args.append(int(image_id))
+        sql += " ORDER BY updated %s" % ("ASC" if order == "asc" else "DESC")
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(int(limit))
+        db = self.connect()
+        try:
+            for (row,) in db.execute(sql,args):
+                yield json.loads(row)
+        finally:
+            db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync the local Hypothesis annotation mirror")
+    parser.add_argument("command",choices=["sync"])
+    parser.add_argument("--db",default=settings.MIRROR_DB)
+    parser.add_argument("--windows",type=int,default=1,help="date windows fetched concurrently")
+    args = parser.parse_args()
+    count = AnnotationMirror(args.db).sync(windows=args.windows)
+    print("Synced %s annotations into %s" %(count,args.db))
@@ -0,0 +1,81 @@
+import threading
+import logging
+import sqlite3
+import time
+import os
+import settings
+import upstream
+
+logger = logging.getLogger(__name__)
+
+
+class RedirectResolver:
+
+    def __init__(self, path=settings.REDIRECT_DB, ttl=settings.REDIRECT_TTL):
+        """Final URL after redirects, remembered in a SQLite table."""
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.execute("CREATE TABLE IF NOT EXISTS redirects "
+                     "(url TEXT PRIMARY KEY, resolved TEXT, resolved_at REAL)")
+        rows = self.execute("SELECT url, resolved, resolved_at FROM redirects")
+        # url -> (resolved, resolved_at)
+        self.redirects = dict((url,(resolved,at)) for url,resolved,at in rows)
+
+    def execute(self, sql, args=()):
+        db = sqlite3.connect(self.path,timeout=30)
+        try:
+            with db:
+                return db.execute(sql,args).fetchall()
+        finally:
+            db.close()
+
+    def fetch(self, url):
+        """Follow redirects without downloading the page."""
+        response = upstream.head(url,allow_redirects=True)
+        if response.status_code < 400:
+            return response.url
+        # Some servers refuse HEAD, stop reading right after the headers
+        response = upstream.get(url,allow_redirects=True,stream=True)
+        response.close()
+        return response.url
+
+    def resolve(self, url):
+        """Canonical URL for url, fetched when unknown or older than the TTL."""
+        cached = self.redirects.get(url)
+        if cached is not None and time.time() - cached[1] < self.ttl:
+            return cached[0]
+        try:
+            resolved = self.fetch(url)
+        except Exception:
+            if cached is None:
+                raise
+            logger.warning("Could not re-resolve %s, keeping %s",url,cached[0])
+            return cached[0]
+        self.store(url,resolved)
+        return resolved
+
+    def store(self, url, resolved):
+        now = time.time()
+        with self.lock:
+            self.redirects[url] = (resolved,now)
+            self.execute("INSERT OR REPLACE INTO redirects VALUES (?, ?, ?)",(url,resolved,now))
+
+    def try_resolve(self, url):
+        try:
+            return self.resolve(url)
+        except Exception:
+            logger.warning("Could not resolve %s",url)
+
+    def preload(self, urls, workers=4):
+        """Resolve urls that are not known (or fresh) yet, in a background thread."""
+        def run():
+            for resolved in upstream.imap(self.try_resolve,urls,workers=workers):
+                pass
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -0,0 +1,38 @@
+"""Serve the portal from one process with gevent (cooperative, non-blocking I/O).
+
+    python serve.py                     # gevent WSGI server
+    gunicorn -k gevent serve:app        # or under gunicorn's gevent worker
+
+Every request runs in a greenlet and the standard library is patched, so
+route handlers and upstream calls yield while they wait on hypothes.is or
+NeuroVault and one process keeps hundreds of requests in flight. The
+synchronous mode (python index.py) is unchanged.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+
+# Greenlets are cheap, let many more upstream requests be in flight than
+# the threaded defaults allow (explicit NVA_* settings still win)
+for name,value in (("UPSTREAM_WORKERS","256"),
+                   ("UPSTREAM_POOL_SIZE","100"),
+                   ("UPSTREAM_HOST_CONCURRENCY","100")):
+    os.environ.setdefault("NVA_%s" % name,value)
+
+from gevent.pywsgi import WSGIServer
+from gevent.pool import Pool
+from index import app
+import settings
+
+
+def serve(host=settings.SERVE_HOST, port=settings.SERVE_PORT,
+          connections=settings.SERVE_CONNECTIONS):
+    """Serve until interrupted, with up to connections requests at once."""
+    server = WSGIServer((host,port),app,spawn=Pool(connections))
+    print("Serving on http://%s:%s (gevent)" %(host,port))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    serve()
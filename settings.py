@@ -0,0 +1,85 @@
+import os
+
+# Everything can be overridden with an NVA_* environment variable
+
+def setting(name, default, cast=str):
+    return cast(os.environ.get("NVA_%s" % name, default))
+
+# Upstream (hypothes.is, neurovault.org) HTTP client
+UPSTREAM_CONNECT_TIMEOUT = setting("UPSTREAM_CONNECT_TIMEOUT", 3.05, float)
+UPSTREAM_READ_TIMEOUT = setting("UPSTREAM_READ_TIMEOUT", 15, float)
+UPSTREAM_RETRIES = setting("UPSTREAM_RETRIES", 3, int)
+UPSTREAM_BACKOFF = setting("UPSTREAM_BACKOFF", 0.25, float)
+UPSTREAM_MAX_BACKOFF = setting("UPSTREAM_MAX_BACKOFF", 10, float)
+UPSTREAM_POOL_SIZE = setting("UPSTREAM_POOL_SIZE", 10, int)
+UPSTREAM_HOST_CONCURRENCY = setting("UPSTREAM_HOST_CONCURRENCY", 8, int)
+
+# Upstream services, pointed at local stand-ins by the benchmarks
+HYPOTHESIS_URL = setting("HYPOTHESIS_URL", "https://hypothes.is")
+NEUROVAULT_URL = setting("NEUROVAULT_URL", "http://neurovault.org")
+
+# Hypothesis search results (entries, seconds fresh, seconds served stale)
+ANNOTATION_CACHE_SIZE = setting("ANNOTATION_CACHE_SIZE", 512, int)
+ANNOTATION_CACHE_TTL = setting("ANNOTATION_CACHE_TTL", 300, float)
+ANNOTATION_CACHE_STALE = setting("ANNOTATION_CACHE_STALE", 3600, float)
+
+# Concurrent upstream calls (worker threads, seconds before rendering partial data)
+UPSTREAM_WORKERS = setting("UPSTREAM_WORKERS", 16, int)
+UPSTREAM_DEADLINE = setting("UPSTREAM_DEADLINE", 10, float)
+
+# NeuroVault image listing (images per page, pages fetched at once per collection)
+IMAGES_PAGE_SIZE = setting("IMAGES_PAGE_SIZE", 100, int)
+IMAGES_WORKERS = setting("IMAGES_WORKERS", 4, int)
+
+# On-disk caches
+CACHE_DIR = setting("CACHE_DIR", "cache")
+
+# Resolved collection page redirects (seconds before a mapping is checked again)
+REDIRECT_DB = setting("REDIRECT_DB", os.path.join(CACHE_DIR, "redirects.sqlite"))
+REDIRECT_TTL = setting("REDIRECT_TTL", 30 * 24 * 3600, float)
+
+# Local annotation mirror, and where collection pages read annotations from
+# ("live" searches hypothes.is, "mirror" queries the synced SQLite copy)
+MIRROR_DB = setting("MIRROR_DB", os.path.join(CACHE_DIR, "annotations.sqlite"))
+ANNOTATION_SOURCE = setting("ANNOTATION_SOURCE", "live")
+
+# Important image fields per collection (entries, seconds fresh, seconds served stale)
+IMAGE_CACHE_SIZE = setting("IMAGE_CACHE_SIZE", 512, int)
+IMAGE_CACHE_TTL = setting("IMAGE_CACHE_TTL", 3600, float)
+IMAGE_CACHE_STALE = setting("IMAGE_CACHE_STALE", 24 * 3600, float)
+
+# Background warm-up of collection caches (upstream requests per minute,
+# seconds before a warmed collection is refreshed again)
+WARMUP_ENABLED = setting("WARMUP_ENABLED", "1") == "1"
+WARMUP_BUDGET = setting("WARMUP_BUDGET", 120, float)
+WARMUP_INTERVAL = setting("WARMUP_INTERVAL", 300, float)
+
+# Hypothesis auth tokens (seconds before expiry to refresh, lifetime when the
+# token does not say)
+HYPOTHESIS_TOKEN_MARGIN = setting("HYPOTHESIS_TOKEN_MARGIN", 300, float)
+HYPOTHESIS_TOKEN_TTL = setting("HYPOTHESIS_TOKEN_TTL", 3600, float)
+
+# Rendered markdown and tag HTML of stream annotations (entries)
+HTML_CACHE_SIZE = setting("HTML_CACHE_SIZE", 10000, int)
+
+# Stream picklist of active users (seconds for an annotation to count half, users listed)
+USER_ACTIVITY_HALF_LIFE = setting("USER_ACTIVITY_HALF_LIFE", 3 * 24 * 3600, float)
+USER_ACTIVITY_LIMIT = setting("USER_ACTIVITY_LIMIT", 50, int)
+
+# Metadata completeness index built offline by completeness.py (snapshot
+# directory, cached image table, collections fetched at once)
+COMPLETENESS_SNAPSHOT = setting("COMPLETENESS_SNAPSHOT", "static/data/nv_completeness")
+IMAGE_TABLE = setting("IMAGE_TABLE", os.path.join(CACHE_DIR, "images.pkl"))
+COMPLETENESS_WORKERS = setting("COMPLETENESS_WORKERS", 4, int)
+
+# JSON API responses (smallest body that is compressed, zlib level)
+API_COMPRESS_MIN_SIZE = setting("API_COMPRESS_MIN_SIZE", 1024, int)
+API_COMPRESS_LEVEL = setting("API_COMPRESS_LEVEL", 6, int)
+
+# Send each response's stage timings in a Server-Timing header
+SERVER_TIMING = setting("SERVER_TIMING", "1") == "1"
+
+# gevent serving mode, serve.py (address, requests handled at once)
+SERVE_HOST = setting("SERVE_HOST", "0.0.0.0")
+SERVE_PORT = setting("SERVE_PORT", 5000, int)
+SERVE_CONNECTIONS = setting("SERVE_CONNECTIONS", 1000, int)
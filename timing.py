@@ -0,0 +1,161 @@
+from contextlib import contextmanager
+from collections import OrderedDict
+from bisect import bisect_left
+import threading
+import time
+import re
+
+# Upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+
+local = threading.local()
+
+
+class Histogram:
+
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        """Prometheus style histogram, one series per tuple of label values."""
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = dict()
+        self.lock = threading.Lock()
+
+    def observe(self, values, seconds):
+        with self.lock:
+            series = self.series.get(values)
+            if series is None:
+                series = self.series[values] = [[0] * (len(self.buckets) + 1),0.0]
+            # Counts per bucket, made cumulative when exported
+            series[0][bisect_left(self.buckets,seconds)] += 1
+            series[1] += seconds
+
+    def lines(self):
+        lines = ["# HELP %s %s" %(self.name,self.help),"# TYPE %s histogram" % self.name]
+        with self.lock:
+            series = sorted((values,list(counts),total) for values,(counts,total) in self.series.items())
+        for values,counts,total in series:
+            labels = list(zip(self.labels,values))
+            cumulative = 0
+            for bound,count in zip(self.buckets + ("+Inf",),counts):
+                cumulative += count
+                lines.append("%s_bucket%s %s" %(self.name,label_text(labels + [("le",bound)]),cumulative))
+            lines.append("%s_sum%s %s" %(self.name,label_text(labels),total))
+            lines.append("%s_count%s %s" %(self.name,label_text(labels),cumulative))
+        return lines
+
+
+class Counter:
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = dict()
+        self.lock = threading.Lock()
+
+    def inc(self, values, amount=1):
+        with self.lock:
+            self.series[values] = self.series.get(values,0) + amount
+
+    def lines(self):
+        lines = ["# HELP %s %s" %(self.name,self.help),"# TYPE %s counter" % self.name]
+        with self.lock:
+            series = sorted(self.series.items())
+        for values,count in series:
+            lines.append("%s%s %s" %(self.name,label_text(zip(self.labels,values)),count))
+        return lines
+
+
+class Spans:
+
+    def __init__(self):
+        """Total seconds per stage name of one request."""
+        self.totals = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.totals[name] = self.totals.get(name,0.0) + seconds
+
+
+stage_seconds = Histogram("nva_stage_seconds","Seconds spent in each stage of a request",("stage",))
+request_seconds = Histogram("nva_request_seconds","Seconds to handle a request",("endpoint","status"))
+upstream_seconds = Histogram("nva_upstream_seconds","Seconds per upstream HTTP request",("host",))
+upstream_responses = Counter("nva_upstream_responses_total","Upstream HTTP responses",("host","status"))
+
+
+def label_text(labels):
+    labels = ['%s="%s"' %(name,str(value).replace("\\","\\\\").replace('"','\\"').replace("\n","\\n"))
+              for name,value in labels]
+    return "{%s}" % ",".join(labels) if labels else ""
+
+def start():
+    """Collect the spans of the current request on this thread."""
+    local.spans = Spans()
+    return local.spans
+
+def stop():
+    spans = getattr(local,"spans",None)
+    local.spans = None
+    return spans
+
+def record(name, seconds):
+    stage_seconds.observe((name,),seconds)
+    spans = getattr(local,"spans",None)
+    if spans is not None:
+        spans.add(name,seconds)
+
+@contextmanager
+def span(name):
+    """Time a stage, for the histograms and the Server-Timing header."""
+    begin = time.time()
+    try:
+        yield
+    finally:
+        record(name,time.time() - begin)
+
+def bind(call):
+    """Wrap call so the spans it records on a pool thread count for this request."""
+    spans = getattr(local,"spans",None)
+    def bound():
+        previous = getattr(local,"spans",None)
+        local.spans = spans
+        try:
+            return call()
+        finally:
+            local.spans = previous
+    return bound
+
+def server_timing(spans, total=None):
+    """Server-Timing header value, durations in milliseconds."""
+    entries = []
+    with spans.lock:
+        items = list(spans.totals.items())
+    if total is not None:
+        items.append(("total",total))
+    for name,seconds in items:
+        entries.append("%s;dur=%.1f" %(re.sub(r"[^\w.-]","_",name),1000.0 * seconds))
+    return ", ".join(entries)
+
+def exposition(*families):
+    """Text exposition of the timing metrics, then of families of extra lines."""
+    lines = []
+    for metric in (stage_seconds,request_seconds,upstream_seconds,upstream_responses):
+        lines.extend(metric.lines())
+    for family in families:
+        lines.extend(family)
+    return "\n".join(lines) + "\n"
+
+def gauge(name, help, series, kind="gauge"):
+    """Lines of a gauge from (labels, value) pairs, None values skipped."""
+    lines = ["# HELP %s %s" %(name,help),"# TYPE %s %s" %(name,kind)]
+    for labels,value in series:
+        if value is not None:
+            lines.append("%s%s %s" %(name,label_text(labels),value))
+    return lines
+
+def counter(name, help, series):
+    """Lines of a counter kept elsewhere, from (labels, value) pairs."""
+    return gauge(name,help,series,kind="counter")
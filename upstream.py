@@ -0,0 +1,332 @@
+from multiprocessing.pool import ThreadPool
+from multiprocessing import TimeoutError
+from requests.adapters import HTTPAdapter
+from collections import deque
+from itertools import islice
+from decimal import Decimal
+import threading
+import json
+import requests
+import logging
+import random
+import time
+import settings
+import timing
+
+# Incremental JSON decoding, using the C yajl backend when it is installed
+try:
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+
+try:
+    from urlparse import urlparse
+    from cookielib import DefaultCookiePolicy
+except ImportError:
+    from urllib.parse import urlparse
+    from http.cookiejar import DefaultCookiePolicy
+
+logger = logging.getLogger(__name__)
+
+# Responses worth another try, after a jittered backoff
+RETRY_STATUS = (429,500,502,503,504)
+
+# Methods that are safe to repeat after a server error or dropped connection
+IDEMPOTENT = ("GET","HEAD","OPTIONS","PUT","DELETE")
+
+
+class UpstreamClient:
+
+    def __init__(self, connect_timeout=settings.UPSTREAM_CONNECT_TIMEOUT,
+                       read_timeout=settings.UPSTREAM_READ_TIMEOUT,
+                       retries=settings.UPSTREAM_RETRIES,
+                       backoff=settings.UPSTREAM_BACKOFF,
+                       max_backoff=settings.UPSTREAM_MAX_BACKOFF,
+                       pool_size=settings.UPSTREAM_POOL_SIZE,
+                       host_concurrency=settings.UPSTREAM_HOST_CONCURRENCY):
+        """Keep-alive connection pools and request limits, one per host."""
+        self.timeout = (connect_timeout,read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.host_concurrency = host_concurrency
+        self.hosts = dict()
+        self.lock = threading.Lock()
+        self.sent = 0  # requests sent, including retries
+
+    def host(self, url):
+        """Session and concurrency limit for the host of url."""
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                session = requests.Session()
+                # Never carry cookies from one caller's response to the next
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                adapter = HTTPAdapter(pool_connections=1,pool_maxsize=self.pool_size)
+                session.mount("http://",adapter)
+                session.mount("https://",adapter)
+                limit = threading.BoundedSemaphore(self.host_concurrency)
+                self.hosts[host] = (session,limit)
+            return self.hosts[host]
+
+    def delay(self, attempt, response=None):
+        """Seconds to wait before retry number attempt (full jitter)."""
+        if response is not None:
+            try:
+                return min(float(response.headers["Retry-After"]),self.max_backoff)
+            except (KeyError,ValueError):
+                pass
+        return random.uniform(0,min(self.max_backoff,self.backoff * 2 ** attempt))
+
+    def observe(self, host, response, seconds):
+        """Upstream latency and status (error when no response came back)."""
+        timing.record("upstream",seconds)
+        timing.upstream_seconds.observe((host,),seconds)
+        status = response.status_code if response is not None else "error"
+        timing.upstream_responses.inc((host,status))
+
+    def send(self, session, limit, host, method, url, kwargs):
+        """One attempt within the host limit.
+
+        A streamed response keeps its slot (and pooled connection) until
+        the body is read and the response closed.
+        """
+        response = None
+        limit.acquire()
+        try:
+            begin = time.time()
+            try:
+                response = session.request(method,url,**kwargs)
+            finally:
+                self.observe(host,response,time.time() - begin)
+        finally:
+            if response is not None and kwargs.get("stream"):
+                release_on_close(response,limit)
+            else:
+                limit.release()
+        return response
+
+    def request(self, method, url, retries=None, **kwargs):
+        """Send a request, retrying connection errors, 429 and 5xx.
+
+        retries overrides the client's, 0 hands every answer to the caller.
+        """
+        if retries is None:
+            retries = self.retries
+        kwargs.setdefault("timeout",self.timeout)
+        method = method.upper()
+        session,limit = self.host(url)
+        host = urlparse(url).netloc
+        attempt = 0
+        while True:
+            response = None
+            with self.lock:
+                self.sent += 1
+            try:
+                response = self.send(session,limit,host,method,url,kwargs)
+            except requests.ConnectTimeout:
+                if attempt >= retries:
+                    raise
+            except (requests.ConnectionError,requests.Timeout):
+                if attempt >= retries or method not in IDEMPOTENT:
+                    raise
+            else:
+                status = response.status_code
+                if status not in RETRY_STATUS or attempt >= retries:
+                    return response
+                if status != 429 and method not in IDEMPOTENT:
+                    return response
+                response.close()
+            time.sleep(self.delay(attempt,response))
+            attempt += 1
+
+
+def release_on_close(response, limit):
+    close = response.close
+    released = []
+    def release():
+        try:
+            close()
+        finally:
+            if not released:
+                released.append(True)
+                limit.release()
+    response.close = release
+
+
+class AdaptiveRateLimiter:
+
+    def __init__(self, rate, min_rate=0.5, max_rate=None, increase=0.5):
+        """Space calls rate per second apart, adapting to the server.
+
+        The rate is halved whenever the server answers 429 and grows back
+        by about increase per second while calls succeed.
+        """
+        self.rate = float(rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate or self.rate * 4
+        self.increase = increase
+        self.next_call = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait for the next call slot."""
+        with self.lock:
+            now = time.time()
+            wait = self.next_call - now
+            self.next_call = max(now,self.next_call) + 1.0 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def update(self, response):
+        with self.lock:
+            if response.status_code == 429:
+                self.rate = max(self.min_rate,self.rate / 2)
+            elif response.status_code < 400:
+                self.rate = min(self.max_rate,self.rate + self.increase / self.rate)
+
+
+# Shared by every upstream call in the process
+client = UpstreamClient()
+
+def get(url, **kwargs):
+    return client.request("GET",url,**kwargs)
+
+def head(url, **kwargs):
+    return client.request("HEAD",url,**kwargs)
+
+def post(url, **kwargs):
+    return client.request("POST",url,**kwargs)
+
+
+# Worker threads for concurrent upstream calls, started on first use.
+# Fan-outs and page fetches use separate pools so one never waits on the other.
+pools = dict()
+pools_lock = threading.Lock()
+local = threading.local()
+
+def get_pool(name="fan_out"):
+    with pools_lock:
+        if name not in pools:
+            pools[name] = ThreadPool(settings.UPSTREAM_WORKERS)
+        return pools[name]
+
+def run_task(call):
+    local.in_pool = True
+    return call()
+
+def fan_out(calls, defaults=None, deadline=settings.UPSTREAM_DEADLINE):
+    """Run independent calls concurrently and return their results in order.
+
+    A call that fails, or is not done within deadline seconds of the
+    start, contributes its default instead, so callers can go on with
+    partial data.
+    """
+    if defaults is None:
+        defaults = [None] * len(calls)
+    # Nested fan-outs run inline instead of waiting on their own pool
+    if getattr(local,"in_pool",False) or len(calls) < 2:
+        tasks = None
+    else:
+        pool = get_pool()
+        tasks = [pool.apply_async(run_task,(call,)) for call in calls]
+    end = time.time() + deadline
+    results = []
+    for i,call in enumerate(calls):
+        try:
+            if tasks is None:
+                results.append(call())
+            else:
+                results.append(tasks[i].get(max(0,end - time.time())))
+        except TimeoutError:
+            logger.warning("Upstream call %s missed the %ss deadline",call,deadline)
+            results.append(defaults[i])
+        except Exception:
+            logger.exception("Upstream call %s failed",call)
+            results.append(defaults[i])
+    return results
+
+def imap(call, items, workers=settings.UPSTREAM_WORKERS, pool="pages"):
+    """Map call over items with up to workers calls in flight.
+
+    Results are yielded in the order of items, as soon as each is ready.
+    A call that itself uses imap must run on a different named pool.
+    """
+    pool = get_pool(pool)
+    items = iter(items)
+    pending = deque(pool.apply_async(call,(item,)) for item in islice(items,workers))
+    while pending:
+        result = pending.popleft().get()
+        for item in islice(items,1):
+            pending.append(pool.apply_async(call,(item,)))
+        yield result
+
+def prefetch(call):
+    """Start call in the background, the caller collects it with .get()."""
+    return get_pool("prefetch").apply_async(call)
+
+
+if ijson is not None:
+    from ijson.common import ObjectBuilder
+
+    class FloatBuilder(ObjectBuilder):
+        """Build decoded objects with floats, like the json module."""
+        def event(self, event, value):
+            if event == 'number' and isinstance(value,Decimal):
+                value = float(value)
+            ObjectBuilder.event(self,event,value)
+
+SCALARS = ('string','number','boolean','null')
+
+def stream_json(response, key):
+    """Decode the list at response[key] one element at a time.
+
+    Returns (meta, items): items is a generator over the list, and meta
+    collects the top-level scalar values (count, next, total...), it is
+    complete once items is exhausted. Without ijson the body is decoded
+    in one go, straight from the socket.
+    """
+    # Error pages must not be decoded (and cached) as empty results
+    try:
+        response.raise_for_status()
+    except Exception:
+        response.close()
+        raise
+    meta = dict()
+
+    def items():
+        try:
+            raw = response.raw
+            raw.decode_content = True
+            if ijson is None:
+                document = json.load(raw)
+                for name,value in document.items():
+                    if name != key:
+                        meta[name] = value
+                for item in document.get(key) or []:
+                    yield item
+                return
+
+            events = ijson.parse(raw)
+            prefix = key + '.item'
+            for current,event,value in events:
+                if current == prefix:
+                    if event in ('start_map','start_array'):
+                        builder = FloatBuilder()
+                        end = event.replace('start','end')
+                        while (current,event) != (prefix,end):
+                            builder.event(event,value)
+                            current,event,value = next(events)
+                        yield builder.value
+                    else:
+                        yield float(value) if isinstance(value,Decimal) else value
+                elif '.' not in current and event in SCALARS:
+                    meta[current] = float(value) if isinstance(value,Decimal) else value
+        finally:
+            response.close()
+
+    return meta,items()
@@ -0,0 +1,126 @@
+from collections import OrderedDict, deque
+import threading
+import logging
+import time
+import settings
+import upstream
+
+logger = logging.getLogger(__name__)
+
+
+class WarmupScheduler:
+
+    def __init__(self, refresh, collections, budget=settings.WARMUP_BUDGET,
+                       interval=settings.WARMUP_INTERVAL, max_views=1000):
+        """Refresh collection caches in the background, most recently viewed first.
+
+        refresh(pk) reloads the caches of one collection and collections()
+        lists every pk, in the order the rest are warmed. Refreshing stops
+        whenever the process went over budget upstream requests a minute:
+        every upstream request is charged, user traffic included.
+        """
+        self.refresh = refresh
+        self.collections = collections
+        self.rate = budget / 60.0
+        self.budget = budget
+        self.interval = interval
+        self.max_views = max_views
+        self.views = OrderedDict()  # pk -> last view, most recent last
+        self.queue = deque()
+        self.refreshed = dict()     # pk -> last refresh
+        self.tokens = budget
+        self.checked = time.time()
+        self.sent = upstream.client.sent  # upstream requests already charged
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def viewed(self, pk):
+        """Record a page view, moving pk to the front of the queue."""
+        pk = int(pk)
+        with self.lock:
+            self.views.pop(pk,None)
+            self.views[pk] = time.time()
+            while len(self.views) > self.max_views:
+                self.views.popitem(last=False)
+        self.wakeup.set()
+
+    def stale(self, pk, now):
+        return now - self.refreshed.get(pk,0) >= self.interval
+
+    def next_collection(self):
+        """The next collection due for a refresh, or None."""
+        now = time.time()
+        with self.lock:
+            for pk in reversed(self.views):
+                if self.stale(pk,now):
+                    return pk
+            for attempt in range(2):
+                while self.queue:
+                    pk = self.queue.popleft()
+                    if self.stale(pk,now):
+                        return pk
+                # Start the next pass over the catalog
+                if attempt == 0:
+                    self.queue.extend(int(pk) for pk in self.collections())
+
+    def wait_for_budget(self):
+        while not self.stopped.is_set():
+            now = time.time()
+            sent = upstream.client.sent
+            # Requests sent since the last check, by anyone, use up the budget
+            spent = sent - self.sent
+            self.sent = sent
+            self.tokens = min(self.budget,self.tokens + (now - self.checked) * self.rate) - spent
+            self.tokens = max(self.tokens,-self.budget)
+            self.checked = now
+            if self.tokens >= 1:
+                return
+            self.stopped.wait((1 - self.tokens) / self.rate)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                pk = self.next_collection()
+            except Exception:
+                logger.exception("Could not list collections to warm up")
+                pk = None
+            if pk is None:
+                # Everything is fresh, wait for a view or the next pass
+                self.wakeup.wait(30)
+                self.wakeup.clear()
+                continue
+            self.wait_for_budget()
+            try:
+                self.refresh(pk)
+            except Exception:
+                logger.exception("Could not warm up collection %s",pk)
+                self.errors += 1
+            with self.lock:
+                self.refreshed[pk] = time.time()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            ages = [now - self.refreshed[pk] for pk in self.refreshed]
+            viewed = sum(1 for pk in self.views if self.stale(pk,now))
+            return {"queue_depth":len(self.queue) + viewed,
+                    "viewed_stale":viewed,
+                    "refreshed":len(self.refreshed),
+                    "oldest_refresh_age":max(ages) if ages else None,
+                    "newest_refresh_age":min(ages) if ages else None,
+                    "errors":self.errors,
+                    "budget_per_minute":self.budget}